@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+'''
+Author: Ioannis Kakogeorgiou
+Email: gkakogeorgiou@gmail.com
+Python Version: 3.7.10
+Description: benchmark_indices.py micro-benchmark of the indices engines of engineering_patches.py
+             on a synthetic 11-band GeoTIFF patch.
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import rasterio
+import numpy as np
+from os.path import dirname as up
+from rasterio.transform import from_origin
+
+sys.path.append(up(os.path.abspath(__file__)))
+from engineering_patches import indices
+
+def synthetic_patch(path, size):
+    # 11-band float32 patch with its _cl.tif and _conf.tif, in the layout of the MARIDA patches folder
+    patch_folder = os.path.join(path, 'patches', 'S2_1-1-20_00XXX')
+    os.makedirs(patch_folder, exist_ok=True)
+    image = os.path.join(patch_folder, 'S2_1-1-20_00XXX_0.tif')
+
+    rng = np.random.RandomState(0)
+    meta = {'driver': 'GTiff', 'height': size, 'width': size, 'count': 11, 'dtype': 'float32',
+            'crs': 'EPSG:32616', 'transform': from_origin(0, 0, 10, 10)}
+
+    with rasterio.open(image, 'w', **meta) as dst:
+        dst.write(rng.uniform(0.0, 0.15, (11, size, size)).astype('float32'))
+
+    meta.update(count = 1, dtype = 'uint8')
+    for suffix in ['_cl.tif', '_conf.tif']:
+        with rasterio.open(image.split('.tif')[0] + suffix, 'w', **meta) as dst:
+            dst.write(rng.randint(0, 4, (1, size, size)).astype('uint8'))
+
+    return image
+
+def main(options):
+
+    path = tempfile.mkdtemp()
+
+    try:
+        image = synthetic_patch(path, options['size'])
+        output_image = os.path.join(path, 'indices', 'S2_1-1-20_00XXX', 'S2_1-1-20_00XXX_0_si.tif')
+
+        results = {}
+        for indices_engine in ['reference', 'fused']:
+
+            indices(image, indices_engine) # Warm-up
+
+            start_time = time.time()
+            for _ in range(options['repeats']):
+                indices(image, indices_engine)
+            elapsed = (time.time() - start_time)/options['repeats']
+
+            with rasterio.open(output_image, mode ='r') as src:
+                results[indices_engine] = src.read()
+
+            print('%-10s %dx%d %8.2f ms/patch' % (indices_engine, options['size'], options['size'], 1000*elapsed))
+
+        print('Max absolute difference: ', np.nanmax(np.abs(results['reference'] - results['fused'])))
+
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    # Options
+    parser.add_argument('--size', default= 256, type=int, help='Size of the synthetic patch')
+    parser.add_argument('--repeats', default= 50, type=int, help='Number of timed runs for each engine')
+
+    args = parser.parse_args()
+    options = vars(args)  # convert to ordinary dict
+
+    main(options)
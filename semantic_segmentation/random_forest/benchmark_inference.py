@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+'''
+Author: Ioannis Kakogeorgiou
+Email: gkakogeorgiou@gmail.com
+Python Version: 3.7.10
+Description: benchmark_inference.py throughput (pixels/second) of the random forest pipeline
+             with scikit-learn and with its ONNX Runtime export (compiled_forest.py) on
+             synthetic 25-feature pixels.
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from sklearn.base import clone
+from os.path import dirname as up
+
+sys.path.append(up(os.path.abspath(__file__)))
+from random_forest import rf_classifier
+from compiled_forest import export_onnx, OnnxForest
+
+def synthetic_pixels(rng, n_pixels, n_features = 25):
+    # Pixels with feature-dependent classes, so that the trees are deep
+    X = (rng.rand(n_pixels, n_features)*rng.rand(n_features)*3 + rng.rand(n_features)).astype('float32')
+    y = np.array(['Marine Debris', 'Marine Water', 'Ship', 'Foam', 'Clouds'], dtype = object)[(X[:,0]*5 + X[:,1]*3 + rng.rand(n_pixels)).astype(int) % 5]
+    return X, y
+
+def timed(predict, X, repeats):
+    predict(X) # Warm-up
+
+    start_time = time.time()
+    for _ in range(repeats):
+        predictions = predict(X)
+    return (time.time() - start_time)/repeats, predictions
+
+def main(options):
+
+    rng = np.random.RandomState(0)
+
+    X_train, y_train = synthetic_pixels(rng, options['n_train'])
+    X_test, _ = synthetic_pixels(rng, options['n_pixels'])
+
+    classifier = clone(rf_classifier).set_params(verbose = False, rf__n_estimators = options['n_estimators'])
+    classifier.fit(X_train, y_train)
+
+    path = tempfile.mkdtemp()
+
+    try:
+        compiled = OnnxForest(export_onnx(classifier, os.path.join(path, 'rf_classifier.onnx')))
+
+        results = {}
+        for name, predictor in [('sklearn', classifier), ('onnx', compiled)]:
+            elapsed, results[name] = timed(predictor.predict, X_test, options['repeats'])
+            print('%-8s %10.0f pixels/second (%.3f seconds for %d pixels)' % (name, options['n_pixels']/elapsed, elapsed, options['n_pixels']))
+
+        print('Agreement of the predictions: %.6f' % np.mean(results['sklearn'] == results['onnx']))
+
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    # Options
+    parser.add_argument('--n_train', default= 100000, type=int, help='Number of synthetic training pixels')
+    parser.add_argument('--n_pixels', default= 65536, type=int, help='Number of predicted pixels (a 256x256 patch)')
+    parser.add_argument('--n_estimators', default= 125, type=int, help='Number of trees (as rf_classifier)')
+    parser.add_argument('--repeats', default= 5, type=int, help='Number of timed runs for each predictor')
+
+    args = parser.parse_args()
+    options = vars(args)  # convert to ordinary dict
+
+    main(options)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+Author: Ioannis Kakogeorgiou
+Email: gkakogeorgiou@gmail.com
+Python Version: 3.7.10
+Description: benchmark_memory.py peak resident memory (RSS) of training and predicting with the
+             random forest pipeline on float64 (previous path) and float32 feature matrices.
+             Each dtype runs in its own process, so that the peaks are independent.
+'''
+
+import os
+import sys
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+from sklearn.base import clone
+from os.path import dirname as up
+
+sys.path.append(up(os.path.abspath(__file__)))
+from random_forest import rf_classifier
+
+def peak_rss():
+    # Peak resident memory of this process in MB (ru_maxrss is in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def synthetic_pixels(rng, n_pixels, dtype, n_features = 25, chunk = 100000):
+    # Filled chunk by chunk, so that no float64 temporary of the whole matrix exists
+    X = np.empty((n_pixels, n_features), dtype = dtype)
+    for start in range(0, n_pixels, chunk):
+        X[start:start + chunk] = rng.rand(min(chunk, n_pixels - start), n_features)
+
+    y = np.array(['Marine Debris', 'Marine Water', 'Ship', 'Foam', 'Clouds'], dtype = object)[(X[:,0]*5 + X[:,1]*3).astype(int) % 5]
+    return X, y
+
+def run(options):
+
+    rng = np.random.RandomState(0)
+
+    X, y = synthetic_pixels(rng, options['n_pixels'], options['dtype'])
+    data_rss = peak_rss()
+
+    classifier = clone(rf_classifier).set_params(verbose = False, rf__n_estimators = options['n_estimators'], rf__oob_score = False)
+
+    start_time = time.time()
+    classifier.fit(X, y)
+    classifier.predict(X)
+
+    print('%-8s data %8.0f MB, peak %8.0f MB (%.1f seconds)' % (options['dtype'], data_rss, peak_rss(), time.time() - start_time))
+
+def main(options):
+
+    for dtype in ['float64', 'float32']:
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--dtype', dtype,
+                        '--n_pixels', str(options['n_pixels']), '--n_estimators', str(options['n_estimators'])], check = True)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    # Options
+    parser.add_argument('--n_pixels', default= 2000000, type=int, help='Number of synthetic pixels (25 features)')
+    parser.add_argument('--n_estimators', default= 10, type=int, help='Number of trees (the memory of the features does not depend on it)')
+    parser.add_argument('--dtype', default= None, type=str, choices=['float64', 'float32'], help='Run a single dtype (default: both, each in its own process)')
+
+    args = parser.parse_args()
+    options = vars(args)  # convert to ordinary dict
+
+    if options['dtype']:
+        run(options)
+    else:
+        main(options)
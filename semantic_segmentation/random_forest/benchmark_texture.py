@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+'''
+Author: Ioannis Kakogeorgiou
+Email: gkakogeorgiou@gmail.com
+Python Version: 3.7.10
+Description: benchmark_texture.py throughput (pixels/second) of the GLCM engines of
+             engineering_patches.py on synthetic grayscale rasters of different sizes.
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from os.path import dirname as up
+
+sys.path.append(up(os.path.abspath(__file__)))
+from engineering_patches import glcm_tiled, glcm_engines
+
+def main(options):
+
+    rng = np.random.RandomState(0)
+
+    for size in options['sizes'].split(','):
+        rows, cols = [int(s) for s in size.split('x')]
+
+        # Synthetic grayscale composite in [0, 1] (as produced by texture())
+        gray = rng.rand(rows, cols)
+
+        for glcm_engine in options['engines'].split(','):
+
+            start_time = time.time()
+            glcm_tiled(gray, options['window_size'], options['max_value'], glcm_engine, options['tile_size'])
+            elapsed = time.time() - start_time
+
+            print('%-10s %5dx%-5d %10.0f pixels/second (%.2f seconds)' % (glcm_engine, rows, cols, rows*cols/elapsed, elapsed))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    # Options
+    parser.add_argument('--sizes', default='256x256,1024x1024,4096x2048', type=str, help='Comma separated raster sizes (rows x cols)')
+    parser.add_argument('--engines', default='vectorized,rolling', type=str, help='Comma separated GLCM engines among: ' + ', '.join(glcm_engines) + ' (reference is very slow on large rasters)')
+    parser.add_argument('--tile_size', default= 256, type=int, help='Size of the tiles the GLCM is computed on')
+
+    # GLCM options
+    parser.add_argument('--window_size', default= 13, type=int, help='Size of the sliding window for the GLCM (use an odd number)')
+    parser.add_argument('--max_value', default= 16, type=int, help=' Number of bins-levels for image quantization for the GLCM (use a power of two)')
+
+    args = parser.parse_args()
+    options = vars(args)  # convert to ordinary dict
+
+    main(options)
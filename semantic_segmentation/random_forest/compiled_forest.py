@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''
+Author: Ioannis Kakogeorgiou
+Email: gkakogeorgiou@gmail.com
+Python Version: 3.7.10
+Description: compiled_forest.py exports the fitted random forest pipeline (rf_classifier.joblib)
+             to ONNX, with the StandardScaler folded into the split thresholds, and provides
+             an ONNX Runtime predictor with the same predict interface as the pipeline.
+'''
+
+import os
+import copy
+import json
+import argparse
+import numpy as np
+from joblib import load
+from os.path import dirname as up
+
+def fold_scaler(classifier):
+    # Copy of the random forest of the Pipeline(StandardScaler, RandomForestClassifier)
+    # with its split thresholds moved to the unscaled feature space:
+    # (x - mean)/scale <= t  <=>  x <= t*scale + mean
+    scaler = classifier.named_steps['scaler']
+    forest = copy.deepcopy(classifier.named_steps['rf'])
+
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        split = tree.children_left != -1                                # Leaves have no threshold
+        feature = tree.feature[split]
+
+        scale = scaler.scale_[feature] if scaler.with_std else 1
+        mean = scaler.mean_[feature] if scaler.with_mean else 0
+
+        tree.threshold[split] = tree.threshold[split]*scale + mean
+
+    return forest
+
+def export_onnx(classifier, onnx_path):
+    # Compile the fitted pipeline to an ONNX tree ensemble (float32 input, no scaler node)
+    from skl2onnx import to_onnx
+    from skl2onnx.common.data_types import FloatTensorType
+
+    forest = fold_scaler(classifier)
+
+    onnx_model = to_onnx(forest, initial_types = [('input', FloatTensorType([None, forest.n_features_in_]))],
+                         options = {id(forest): {'zipmap': False}})
+
+    # Classes in the order of the probabilities (as rf_classifier.classes_)
+    meta = onnx_model.metadata_props.add()
+    meta.key, meta.value = 'classes', json.dumps(forest.classes_.tolist())
+
+    with open(onnx_path, 'wb') as f:
+        f.write(onnx_model.SerializeToString())
+
+    return onnx_path
+
+class OnnxForest():
+    # ONNX Runtime predictor with the predict/predict_proba interface of rf_classifier
+    def __init__(self, onnx_path, n_threads = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = n_threads                        # 0: all cores
+
+        self.session = ort.InferenceSession(onnx_path, sess_options = options, providers = ['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        self.classes_ = np.array(json.loads(self.session.get_modelmeta().custom_metadata_map['classes']), dtype = object)
+
+    def run(self, X):
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(X, dtype = np.float32)})
+
+    def predict_proba(self, X):
+        return self.run(X)[1]
+
+    def predict(self, X):
+        return self.run(X)[0]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    # Options
+    parser.add_argument('--classifier', default=os.path.join(up(os.path.abspath(__file__)), 'rf_classifier.joblib'), help='Path to the fitted pipeline (produced by train_eval.py)')
+    parser.add_argument('--onnx_path', default=os.path.join(up(os.path.abspath(__file__)), 'rf_classifier.onnx'), help='Path to the exported ONNX model')
+
+    args = parser.parse_args()
+    options = vars(args)  # convert to ordinary dict
+
+    print('ONNX model is saved at: ' + export_onnx(load(options['classifier']), options['onnx_path']))
@@ -7,6 +7,8 @@ Description: engineering_patches.py production of patches with indices, texture,
              for the pixel-level semantic segmentation with random forest classifier.
 '''
 import os
+import json
+import hashlib
 import argparse
 import rasterio
 import numpy as np
@@ -16,6 +18,7 @@ from shutil import copyfile
 from skimage import feature
 from functools import partial
 from os.path import dirname as up
+from rasterio.windows import Window
 from skimage.color import rgb2gray
 from joblib import Parallel, delayed
 from skimage.feature import greycomatrix, greycoprops, local_binary_pattern
@@ -63,6 +66,61 @@ def ndmi(band8, band10):
 def bsi(band2, band4, band8, band10):
     return ((band10 + band4)-(band8 + band2))/((band10 + band4)+(band8 + band2))
 
+# Bands needed for the indices
+indices_bands = (2, 3, 4, 6, 8, 10)
+
+def all_indices(bands, out = None):
+    # NDVI, FAI, FDI, SI, NDWI, NRD, NDMI, BSI from the cube of indices_bands in a single pass.
+    # Same operations (and order) as the functions above, written in place to the (8, H, W) output.
+    band2, band3, band4, band6, band8, band10 = bands
+
+    if out is None:
+        out = np.empty((8,) + band2.shape, dtype=bands.dtype)
+
+    NDVI, FAI, FDI, SI, NDWI, NRD, NDMI, BSI = out
+    temp = np.empty((2,) + band2.shape, dtype=bands.dtype)
+
+    # NRD is also the numerator of NDVI
+    np.subtract(band8, band4, out=NRD)
+    np.add(band8, band4, out=temp[0])
+    np.divide(NRD, temp[0], out=NDVI)
+
+    np.subtract(band10, band4, out=temp[0])
+    temp[0] *= (833.0 - 665.0)
+    temp[0] /= (1614.0 - 665.0)
+    temp[0] += band4
+    np.subtract(band8, temp[0], out=FAI)
+
+    np.subtract(band10, band6, out=temp[0])
+    temp[0] *= 10
+    temp[0] *= (833.0 - 740.0)
+    temp[0] /= (1614.0 - 740.0)
+    temp[0] += band6
+    np.subtract(band8, temp[0], out=FDI)
+
+    np.subtract(1, band2, out=temp[0])
+    np.subtract(1, band3, out=temp[1])
+    temp[0] *= temp[1]
+    np.subtract(1, band4, out=temp[1])
+    temp[0] *= temp[1]
+    np.power(temp[0], 1/3, out=SI)
+
+    np.subtract(band3, band8, out=NDWI)
+    np.add(band3, band8, out=temp[0])
+    NDWI /= temp[0]
+
+    np.subtract(band8, band10, out=NDMI)
+    np.add(band8, band10, out=temp[0])
+    NDMI /= temp[0]
+
+    np.add(band10, band4, out=temp[0])
+    np.add(band8, band2, out=temp[1])
+    np.subtract(temp[0], temp[1], out=BSI)
+    temp[0] += temp[1]
+    BSI /= temp[0]
+
+    return out
+
 # GLCM properties
 def glcm_feature(matrix_coocurrence):
     contrast = greycoprops(matrix_coocurrence, 'contrast')
@@ -74,26 +132,296 @@ def glcm_feature(matrix_coocurrence):
     
     return contrast.item(), dissimilarity.item(), homogeneity.item(), energy.item(), correlation.item(), asm.item()
 
-def indices(image):
+def glcm_quantize(gray, window_size = 13, max_value = 16, tile_size = 256):
+    # Quantize and reflect-pad the whole raster once (same levels as np.digitize on each window).
+    # The levels are stored in the smallest integer dtype (uint8 up to 255 levels) and
+    # np.digitize runs on tile_size rows at a time, so its int64 output stays small
+
+    bins = np.linspace(0.00, 1.00,max_value)
+
+    assert (window_size -1)%2==0
+
+    inds = np.empty(gray.shape, dtype=np.min_scalar_type(max_value))
+    for row in range(0, gray.shape[0], tile_size):
+        inds[row:row + tile_size] = np.digitize(gray[row:row + tile_size], bins)
+
+    return np.pad(inds, (window_size-1)//2, mode='reflect')
+
+# GLCM with scikit-image on each sliding window
+def glcm_reference(inds, window_size = 13, max_value = 16):
+
+    num_levels = max_value+1
+
+    features_results=np.zeros((inds.shape[0]-window_size+1, inds.shape[1]-window_size+1, 6), dtype=np.float64)
+
+    # Row-major traversal of the windows (C-ordered arrays)
+    for row in range(features_results.shape[0]):
+        for col in range(features_results.shape[1]):
+            inds_window = inds[row:row + window_size, col:col + window_size]
+
+            # Calculate on E, NE, N, NW as well as symmetric. So calculation on all directions and with 1 pixel offset-distance
+            matrix_coocurrence = greycomatrix(inds_window, [1], [0, np.pi/4, np.pi/2, 3*np.pi/4], levels=num_levels, normed=True, symmetric=True)
+
+            # Aggregate all directions
+            matrix_coocurrence = matrix_coocurrence.mean(3)[:,:,:,np.newaxis]
+
+            features_results[row,col,:] = glcm_feature(matrix_coocurrence)
+
+    return features_results
+
+# Pixel offsets (row, col) of the E, NE, N, NW neighbours with 1 pixel offset-distance
+glcm_offsets = [(0, 1), (1, 1), (1, 0), (1, -1)]
+
+def box_sum(array, height, width):
+    # Sum of every height x width window of a 2D array through its integral image
+    integral = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(array, axis=0, dtype=np.int64), axis=1, out=integral[1:,1:])
+
+    return integral[height:,width:] - integral[:-height,width:] - integral[height:,:-width] + integral[:-height,:-width]
+
+def glcm_pair_codes(inds, window_size = 13, max_value = 16):
+    # Level pair of every E, NE, N, NW neighbour pair of the padded and quantized raster
+
+    num_levels = max_value+1
+    code_dtype = np.min_scalar_type(num_levels**2 - 1)
+
+    pair_codes = []
+    for row_off, col_off in glcm_offsets:
+        first = inds[:inds.shape[0]-row_off, max(0,-col_off):inds.shape[1]-max(0,col_off)]
+        second = inds[row_off:, max(0,col_off):inds.shape[1]-max(0,-col_off)]
+
+        # Symmetric matrix, so only the unordered level pair (low, high) matters
+        pair_codes.append(np.minimum(first, second).astype(code_dtype)*num_levels + np.maximum(first, second))
+
+    # Each direction is normalized by its own number of pairs before averaging. Scaling the
+    # counts by the common denominator window_size*(window_size-1)**2 keeps all sums integer,
+    # so each pair has weight (window_size-1) for E and N, window_size for NE and NW
+    pair_weights = [window_size-1 if (row_off==0 or col_off==0) else window_size for row_off, col_off in glcm_offsets]
+
+    return pair_codes, pair_weights
+
+def glcm_code_coefs(max_value = 16):
+    # Contribution of one weighted (low, high) level pair to the GLCM sums
+    num_levels = max_value+1
+    i, j = np.divmod(np.arange(num_levels**2), num_levels)
+
+    linear = np.stack([2*(i-j)**2,     # contrast
+                       2*np.abs(i-j),  # dissimilarity
+                       i+j,            # mean
+                       i**2+j**2,      # second moment
+                       2*i*j])         # cross moment
+    homo = 2.0/(1.0+(i-j)**2)
+    asm = np.where(i==j, 4, 2)
+
+    return linear, homo, asm
+
+def glcm_props(linear, homo, asm, window_size = 13):
+    # CON, DIS, HOMO, ENER, COR, ASM from the weighted GLCM sums of glcm_code_coefs
+    total = 8*window_size*(window_size-1)**2
+    con, dis, sum_i, sum_ii, sum_ij = linear
+
+    # Variance and covariance scaled by total**2 (exact in integers)
+    var = total*sum_ii - sum_i**2
+    cov = total*sum_ij - sum_i**2
+
+    features_results = np.zeros(con.shape + (6,), dtype=np.float64)
+    features_results[...,0] = con/total
+    features_results[...,1] = dis/total
+    features_results[...,2] = homo/total
+    features_results[...,5] = asm/float(total)**2
+    features_results[...,3] = np.sqrt(features_results[...,5])
+    features_results[...,4] = np.where(var > 0, cov/np.where(var > 0, var, 1), 1.0)
+
+    return features_results
+
+# GLCM for all sliding windows at once
+def glcm_vectorized(inds, window_size = 13, max_value = 16):
+
+    shape = (inds.shape[0]-window_size+1, inds.shape[1]-window_size+1)
+    pair_codes, pair_weights = glcm_pair_codes(inds, window_size, max_value)
+    linear_coefs, homo_coefs, asm_coefs = glcm_code_coefs(max_value)
+
+    linear = np.zeros((5,) + shape, dtype=np.int64)
+    homo = np.zeros(shape, dtype=np.float64)
+    asm = np.zeros(shape, dtype=np.int64)
+
+    for code in np.unique(np.concatenate([c.ravel() for c in pair_codes])):
+
+        # Weighted count of the (i, j) and (j, i) cells on every window
+        count = np.zeros(shape, dtype=np.int64)
+        for (row_off, col_off), codes, weight in zip(glcm_offsets, pair_codes, pair_weights):
+            count += weight*box_sum(codes==code, window_size - row_off, window_size - abs(col_off))
+
+        linear += linear_coefs[:,code,np.newaxis,np.newaxis]*count
+        homo += homo_coefs[code]*count
+        asm += asm_coefs[code]*count**2
+
+    return glcm_props(linear, homo, asm, window_size)
+
+# GLCM with a running co-occurrence histogram along each row of windows
+def glcm_rolling(inds, window_size = 13, max_value = 16):
+
+    shape = (inds.shape[0]-window_size+1, inds.shape[1]-window_size+1)
+    pair_codes, pair_weights = glcm_pair_codes(inds, window_size, max_value)
+    linear_coefs, homo_coefs, asm_coefs = glcm_code_coefs(max_value)
+    num_codes = (max_value+1)**2
+
+    linear = np.zeros((5,) + shape, dtype=np.int64)
+    homo = np.zeros(shape, dtype=np.float64)
+    asm = np.zeros(shape, dtype=np.int64)
+
+    for row in range(shape[0]):
+
+        # Pairs of each direction in the window of the first column
+        columns = [codes[row:row + window_size - row_off] for (row_off, col_off), codes in zip(glcm_offsets, pair_codes)]
+        counts = sum(weight*np.bincount(c[:,:window_size - abs(col_off)].ravel(), minlength=num_codes)
+                     for (row_off, col_off), c, weight in zip(glcm_offsets, columns, pair_weights))
+
+        for col in range(shape[1]):
+            if col > 0:
+                # Slide right: drop the pairs of the outgoing column, add those of the incoming one
+                for (row_off, col_off), c, weight in zip(glcm_offsets, columns, pair_weights):
+                    counts -= weight*np.bincount(c[:,col-1], minlength=num_codes)
+                    counts += weight*np.bincount(c[:,col-1 + window_size - abs(col_off)], minlength=num_codes)
+
+            linear[:,row,col] = linear_coefs @ counts
+            homo[row,col] = homo_coefs @ counts
+            asm[row,col] = asm_coefs @ counts**2
+
+    return glcm_props(linear, homo, asm, window_size)
+
+glcm_engines = {'reference': glcm_reference,
+                'vectorized': glcm_vectorized,
+                'rolling': glcm_rolling}
+
+def glcm_tiles(gray, window_size = 13, max_value = 16, glcm_engine = 'reference', tile_size = 256):
+    # GLCM features of an arbitrary HxW raster, computed tile by tile in row-major order.
+    # Each tile reads its window halo from the padded raster, so tiles match the untiled result.
+    # Yields the Window of each tile and its (6, rows, cols) features
+    inds = glcm_quantize(gray, window_size, max_value, tile_size)
+
+    for row in range(0, gray.shape[0], tile_size):
+        for col in range(0, gray.shape[1], tile_size):
+            tile_rows = min(tile_size, gray.shape[0] - row)
+            tile_cols = min(tile_size, gray.shape[1] - col)
+
+            inds_tile = inds[row:row + tile_rows + window_size - 1, col:col + tile_cols + window_size - 1]
+            features_results = glcm_engines[glcm_engine](inds_tile, window_size, max_value)
+
+            yield Window(col, row, tile_cols, tile_rows), np.moveaxis(features_results, -1, 0)
+
+def glcm_tiled(gray, window_size = 13, max_value = 16, glcm_engine = 'reference', tile_size = 256):
+    # GLCM features of the whole raster as a (H, W, 6) float32 array
+    features_results = np.zeros((gray.shape[0], gray.shape[1], 6), dtype=np.float32)
+
+    for window, features_tile in glcm_tiles(gray, window_size, max_value, glcm_engine, tile_size):
+        features_results[window.toslices()] = np.moveaxis(features_tile, 0, -1)
+
+    return features_results
+
+feature_suffixes = {'indices': '_si.tif',
+                    'texture': '_glcm.tif',
+                    'spatial': '_spatial.tif',
+                    'lbp': '_lbp.tif'}
+
+def feature_path(image, feature_type, suffix):
+    # Output file of a feature family (folder next to patches) for the image patch
+    output_path = os.path.join(up(up(up(image))),feature_type, '_'.join(os.path.basename(image).split('_')[:-1]))
     
-    output_path = os.path.join(up(up(up(image))),'indices', '_'.join(os.path.basename(image).split('_')[:-1]))
-    output_image = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_si.tif')
+    return os.path.join(output_path, os.path.basename(image).split('.')[0] + suffix)
+
+def link_labels(src, dst, labels = 'copy'):
+    # Copy, hard link or symbolic link of a label file (replaces any previous one)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    
+    if labels == 'copy':
+        copyfile(src, dst)
+    elif labels == 'hardlink':
+        os.link(src, dst)
+    elif labels == 'symlink':
+        os.symlink(os.path.relpath(src, up(dst)), dst)
+    else:
+        raise AssertionError("Wrong labels, select between copy, hardlink, symlink or none")
+
+def feature_output(image, feature_type, suffix, labels = 'copy'):
+    output_image = feature_path(image, feature_type, suffix)
+    output_path = up(output_image)
     os.makedirs(output_path, exist_ok=True)
     
-    # Copy _conf.tif and _cl.tif for seamless integration with spectral_extraction.py
+    # Nothing else to write when spectral_extraction.py reads the labels from the patches folder (--label_root)
+    if labels == 'none':
+        return output_image
+    
+    # Copy (or link) _conf.tif and _cl.tif for seamless integration with spectral_extraction.py
     src_conf = os.path.abspath(image.split('.tif')[0] + '_conf.tif')
     dst_conf = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_conf.tif')
-    copyfile(src_conf, dst_conf)
+    link_labels(src_conf, dst_conf, labels)
     
     src_cl = os.path.abspath(image.split('.tif')[0] + '_cl.tif')
     dst_cl = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_cl.tif')
-    copyfile(src_cl, dst_cl)
+    link_labels(src_cl, dst_cl, labels)
+    
+    return output_image
+
+def write_features(output_image, features_results, meta, tags):
+    # Write a (layers, H, W) feature stack with the metadata of the initial image
+    meta = dict(meta, count = features_results.shape[0])
+    
+    with rasterio.open(output_image, 'w', **meta) as dst:
+        dst.write(features_results.astype(meta['dtype'], copy=False))
+        dst.update_tags(**tags)
+
+def write_tiles(output_image, tiles, count, meta, tags):
+    # Write a (count, H, W) feature stack tile by tile (windowed writes), so only one
+    # tile of features is in memory at a time
+    meta = dict(meta, count = count)
+    
+    with rasterio.open(output_image, 'w', **meta) as dst:
+        for window, features_tile in tiles:
+            dst.write(features_tile.astype(meta['dtype'], copy=False), window = window)
+        dst.update_tags(**tags)
+
+def grayscale(img):
+    # From RGB Composite (bands 2, 3, 4) to Grayscale
+    img = np.moveaxis(img, [0, 1, 2], [2, 0, 1])
+    rgb_composite = img[:,:,[2,1,0]]
+    rgb_composite[rgb_composite<0.0]=0.0
+    rgb_composite[rgb_composite>0.15]=0.15
+    rgb_composite = (rgb_composite)/0.15
+    
+    return rgb2gray(rgb_composite)
+
+def spatial_features(gray, sigma_min = 1, sigma_max = 16):
+    features_func = partial(feature.multiscale_basic_features,
+                            intensity=True, edges=True, texture=True,
+                            sigma_min=sigma_min, sigma_max=sigma_max)
+    
+    return np.moveaxis(features_func(gray), -1, 0)
+
+def lbp_features(gray, radius = 3, n_points = 24):
+    features_results_default = local_binary_pattern(gray, n_points, radius, 'default')
+    features_results_uniform = local_binary_pattern(gray, n_points, radius, 'uniform')
+    
+    return np.stack([features_results_default, features_results_uniform])
+
+def indices(image, indices_engine = 'reference', labels = 'copy'):
+    
+    output_image = feature_output(image, 'indices', '_si.tif', labels)
     
     # Read metadata of the initial image
     with rasterio.open(image, mode ='r') as src:
         tags = src.tags().copy()
         meta = src.meta
 
+    if indices_engine == 'fused':
+        # Read the needed bands once and write all the indices at once
+        with rasterio.open(image, mode ='r') as src:
+            bands = src.read(indices_bands).astype(np.float32, copy=False)
+        
+        write_features(output_image, all_indices(bands), meta, tags)
+        return
+
     # Update meta to reflect the number of layers
     meta.update(count = 8)
 
@@ -126,200 +454,241 @@ def indices(image):
 
         dst.update_tags(**tags)
 
-def texture(image, window_size = 13, max_value = 16):
-    
-    output_path = os.path.join(up(up(up(image))),'texture', '_'.join(os.path.basename(image).split('_')[:-1]))
-    output_image = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_glcm.tif')
-    os.makedirs(output_path, exist_ok=True)
+def texture(image, window_size = 13, max_value = 16, glcm_engine = 'reference', tile_size = 256, labels = 'copy'):
     
-    # Copy _conf.tif and _cl.tif for seamless integration with spectral_extraction.py
-    src_conf = os.path.abspath(image.split('.tif')[0] + '_conf.tif')
-    dst_conf = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_conf.tif')
-    copyfile(src_conf, dst_conf)
-    
-    src_cl = os.path.abspath(image.split('.tif')[0] + '_cl.tif')
-    dst_cl = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_cl.tif')
-    copyfile(src_cl, dst_cl)
+    output_image = feature_output(image, 'texture', '_glcm.tif', labels)
     
-    # Read metadata of the initial image
     with rasterio.open(image, mode ='r') as src:
         tags = src.tags().copy()
         meta = src.meta
-        dtype = src.read(1).dtype
-
-    # Update meta to reflect the number of layers
-    meta.update(count = 6)
+        gray = grayscale(src.read((2,3,4)))
     
-    # Write it to stack
-    with rasterio.open(output_image, 'w', **meta) as dst:
-        with rasterio.open(image, mode ='r') as src:
-            img = src.read((2,3,4)).astype(dtype).copy()
-            
-            # From RGB Composite to Grayscale
-            img = np.moveaxis(img, [0, 1, 2], [2, 0, 1])
-            rgb_composite = img[:,:,[2,1,0]]
-            rgb_composite[rgb_composite<0.0]=0.0
-            rgb_composite[rgb_composite>0.15]=0.15
-            rgb_composite = (rgb_composite)/0.15
-            gray = rgb2gray(rgb_composite)
-
-            bins = np.linspace(0.00, 1.00,max_value)
-            num_levels = max_value+1
-
-            assert (window_size -1)%2==0
-            
-            #
-            temp_gray = np.pad(gray, (window_size-1)//2, mode='reflect')
-
-            features_results=np.zeros((gray.shape[0], gray.shape[1], 6), dtype=dtype)
-
-            for col in range((window_size-1)//2, gray.shape[0]+(window_size-1)//2):
-                for row in range((window_size-1)//2, gray.shape[0]+(window_size-1)//2):
-                    temp_gray_window = temp_gray[row - (window_size -1)//2: row + (window_size -1)//2 + 1, 
-                                                 col - (window_size -1)//2: col + (window_size -1)//2 + 1]
-
-                    inds = np.digitize(temp_gray_window, bins)
+    write_tiles(output_image, glcm_tiles(gray, window_size, max_value, glcm_engine, tile_size), 6, meta, tags)
 
-                    # Calculate on E, NE, N, NW as well as symmetric. So calculation on all directions and with 1 pixel offset-distance
-                    matrix_coocurrence = greycomatrix(inds, [1], [0, np.pi/4, np.pi/2, 3*np.pi/4], levels=num_levels, normed=True, symmetric=True)
-
-                    # Aggregate all directions
-                    matrix_coocurrence = matrix_coocurrence.mean(3)[:,:,:,np.newaxis]
-
-                    con, dis, homo, ener, cor, asm = glcm_feature(matrix_coocurrence)
-                    features_results[row - (window_size -1)//2,col - (window_size -1)//2,0] = con
-                    features_results[row - (window_size -1)//2,col - (window_size -1)//2,1] = dis
-                    features_results[row - (window_size -1)//2,col - (window_size -1)//2,2] = homo
-                    features_results[row - (window_size -1)//2,col - (window_size -1)//2,3] = ener
-                    features_results[row - (window_size -1)//2,col - (window_size -1)//2,4] = cor
-                    features_results[row - (window_size -1)//2,col - (window_size -1)//2,5] = asm
-            
-            dst.write_band(1, features_results[:,:,0])
-            dst.write_band(2, features_results[:,:,1])
-            dst.write_band(3, features_results[:,:,2])
-            dst.write_band(4, features_results[:,:,3])
-            dst.write_band(5, features_results[:,:,4])
-            dst.write_band(6, features_results[:,:,5])
-
-        dst.update_tags(**tags)
-
-
-def spatial(image, sigma_min = 1, sigma_max = 16):
+def spatial(image, sigma_min = 1, sigma_max = 16, labels = 'copy'):
     
-    output_path = os.path.join(up(up(up(image))),'spatial', '_'.join(os.path.basename(image).split('_')[:-1]))
-    output_image = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_spatial.tif')
-    os.makedirs(output_path, exist_ok=True)
+    output_image = feature_output(image, 'spatial', '_spatial.tif', labels)
     
-    # Copy _conf.tif and _cl.tif for seamless integration with spectral_extraction.py
-    src_conf = os.path.abspath(image.split('.tif')[0] + '_conf.tif')
-    dst_conf = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_conf.tif')
-    copyfile(src_conf, dst_conf)
+    with rasterio.open(image, mode ='r') as src:
+        tags = src.tags().copy()
+        meta = src.meta
+        gray = grayscale(src.read((2,3,4)))
     
-    src_cl = os.path.abspath(image.split('.tif')[0] + '_cl.tif')
-    dst_cl = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_cl.tif')
-    copyfile(src_cl, dst_cl)
+    write_features(output_image, spatial_features(gray, sigma_min, sigma_max), meta, tags)
+
+def lbp(image, radius = 3, n_points = 24, labels = 'copy'):
+    
+    output_image = feature_output(image, 'lbp', '_lbp.tif', labels)
     
-    # Read metadata of the initial image
     with rasterio.open(image, mode ='r') as src:
         tags = src.tags().copy()
         meta = src.meta
-        dtype = src.read(1).dtype
-
-    # Update meta to reflect the number of layers
-    meta.update(count = 20)
+        gray = grayscale(src.read((2,3,4)))
     
-    # Write it to stack
-    with rasterio.open(output_image, 'w', **meta) as dst:
-        with rasterio.open(image, mode ='r') as src:
-            img = src.read((2,3,4)).astype(dtype).copy()
-            
-            # From RGB Composite to Grayscale
-            img = np.moveaxis(img, [0, 1, 2], [2, 0, 1])
-            rgb_composite = img[:,:,[2,1,0]]
-            rgb_composite[rgb_composite<0.0]=0.0
-            rgb_composite[rgb_composite>0.15]=0.15
-            rgb_composite = (rgb_composite)/0.15
-            gray = rgb2gray(rgb_composite)
-
-            features_func = partial(feature.multiscale_basic_features,
-                                    intensity=True, edges=True, texture=True,
-                                    sigma_min=sigma_min, sigma_max=sigma_max)
-            features_results = features_func(gray).astype(dtype)
-            
-            for i in range(20):
-                dst.write_band(i+1, features_results[:,:,i])
-
-        dst.update_tags(**tags)
+    write_features(output_image, lbp_features(gray, radius, n_points), meta, tags)
 
+feature_types = list(feature_suffixes)
 
-def lbp(image, radius = 3, n_points = 24):
+def fused(image, types, options):
+    # Several feature families from a single read of the patch and a single grayscale composite
+    with rasterio.open(image, mode ='r') as src:
+        tags = src.tags().copy()
+        meta = src.meta
+        img = src.read()
     
-    output_path = os.path.join(up(up(up(image))),'lbp', '_'.join(os.path.basename(image).split('_')[:-1]))
-    output_image = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_lbp.tif')
-    os.makedirs(output_path, exist_ok=True)
+    if 'indices' in types:
+        bands = img[[band-1 for band in indices_bands]].astype(np.float32, copy=False)
+        write_features(feature_output(image, 'indices', '_si.tif', options['labels']), all_indices(bands), meta, tags)
     
-    # Copy _conf.tif and _cl.tif for seamless integration with spectral_extraction.py
-    src_conf = os.path.abspath(image.split('.tif')[0] + '_conf.tif')
-    dst_conf = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_conf.tif')
-    copyfile(src_conf, dst_conf)
+    if set(types) & {'texture', 'spatial', 'lbp'}:
+        gray = grayscale(img[1:4])
     
-    src_cl = os.path.abspath(image.split('.tif')[0] + '_cl.tif')
-    dst_cl = os.path.join(output_path, os.path.basename(image).split('.')[0] + '_cl.tif')
-    copyfile(src_cl, dst_cl)
+    if 'texture' in types:
+        tiles = glcm_tiles(gray, options['window_size'], options['max_value'], options['glcm_engine'], options['tile_size'])
+        write_tiles(feature_output(image, 'texture', '_glcm.tif', options['labels']), tiles, 6, meta, tags)
     
-    # Read metadata of the initial image
-    with rasterio.open(image, mode ='r') as src:
-        tags = src.tags().copy()
-        meta = src.meta
-        dtype = src.read(1).dtype
+    if 'spatial' in types:
+        write_features(feature_output(image, 'spatial', '_spatial.tif', options['labels']), spatial_features(gray, 1, 16), meta, tags)
+    
+    if 'lbp' in types:
+        write_features(feature_output(image, 'lbp', '_lbp.tif', options['labels']), lbp_features(gray, options['radius'], options['n_points']), meta, tags)
+
+class ProgressParallel(Parallel):
+    # joblib Parallel with a progress bar on the completed (not the dispatched) patches
+    def __init__(self, total = None, **kwargs):
+        self.total = total
+        Parallel.__init__(self, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        with tqdm(total = self.total) as self.progress_bar:
+            return Parallel.__call__(self, *args, **kwargs)
+
+    def print_progress(self):
+        self.progress_bar.n = self.n_completed_tasks
+        self.progress_bar.refresh()
+
+###############################################################
+# Incremental rebuild                                         #
+###############################################################
+
+def feature_params(feature_type, options):
+    # Parameters the outputs of a feature family depend on (the engines give the same outputs),
+    # and how the _cl.tif and _conf.tif are placed next to them
+    if feature_type == 'texture':
+        params = {'window_size': options['window_size'], 'max_value': options['max_value']}
+    elif feature_type == 'spatial':
+        params = {'sigma_min': 1, 'sigma_max': 16}
+    elif feature_type == 'lbp':
+        params = {'radius': options['radius'], 'n_points': options['n_points']}
+    else:
+        params = {}
+    
+    params['labels'] = options['labels']
+    
+    return params
 
-    # Update meta to reflect the number of layers
-    meta.update(count = 2)
+def output_files(image, feature_type, labels = 'copy'):
+    # Files written for a feature family of the image patch
+    suffixes = [feature_suffixes[feature_type]] + ([] if labels == 'none' else ['_cl.tif', '_conf.tif'])
     
-    # Write it to stack
-    with rasterio.open(output_image, 'w', **meta) as dst:
-        with rasterio.open(image, mode ='r') as src:
-            img = src.read((2,3,4)).astype(dtype).copy()
-            
-            # From RGB Composite to Grayscale
-            img = np.moveaxis(img, [0, 1, 2], [2, 0, 1])
-            rgb_composite = img[:,:,[2,1,0]]
-            rgb_composite[rgb_composite<0.0]=0.0
-            rgb_composite[rgb_composite>0.15]=0.15
-            rgb_composite = (rgb_composite)/0.15
-            gray = rgb2gray(rgb_composite)
+    return [feature_path(image, feature_type, suffix) for suffix in suffixes]
 
-            features_results_default = local_binary_pattern(gray, n_points, radius, 'default').astype(dtype)
-            features_results_uniform = local_binary_pattern(gray, n_points, radius, 'uniform').astype(dtype)
+def source_files(image):
+    # Size and modification time of the patch and its _cl.tif and _conf.tif
+    files = [image, image.split('.tif')[0] + '_cl.tif', image.split('.tif')[0] + '_conf.tif']
+    
+    return {os.path.basename(f): [os.path.getsize(f), os.path.getmtime(f)] for f in files}
+
+def source_hash(image):
+    md5 = hashlib.md5()
+    for f in [image, image.split('.tif')[0] + '_cl.tif', image.split('.tif')[0] + '_conf.tif']:
+        with open(f, 'rb') as src:
+            for chunk in iter(lambda: src.read(1 << 20), b''):
+                md5.update(chunk)
+    
+    return md5.hexdigest()
 
-            dst.write_band(1, features_results_default)
-            dst.write_band(2, features_results_uniform)
+def load_manifest(path, feature_type):
+    manifest_file = os.path.join(path, feature_type, 'manifest.json')
+    
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    
+    return {}
 
-        dst.update_tags(**tags)        
+def save_manifest(path, feature_type, manifest):
+    manifest_file = os.path.join(path, feature_type, 'manifest.json')
+    os.makedirs(up(manifest_file), exist_ok=True)
+    
+    # Replace the previous manifest only once the new one is fully written
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def incremental_tasks(patches, types, options):
+    # Feature families of each patch whose outputs are missing, or whose source or parameters changed
+    manifests = {feature_type: load_manifest(options['path'], feature_type) for feature_type in types}
+    skipped = {feature_type: 0 for feature_type in types}
+    tasks = []
+    
+    for image in patches:
+        name = os.path.basename(image)
+        files = source_files(image)
+        image_hash = None
+        stale = []
+        
+        for feature_type in types:
+            entry = manifests[feature_type].get(name)
+            params = feature_params(feature_type, options)
+            
+            up_to_date = (entry is not None and entry['params'] == params and
+                          all(os.path.exists(f) for f in output_files(image, feature_type, options['labels'])))
+            
+            # Touched or copied source files are still up-to-date if their content is the same.
+            # Entries without a hash (written by full runs) cannot be compared and are regenerated
+            if up_to_date and entry['files'] != files:
+                if entry.get('hash') is None:
+                    up_to_date = False
+                else:
+                    image_hash = image_hash or source_hash(image)
+                    up_to_date = entry['hash'] == image_hash
+            
+            if up_to_date:
+                skipped[feature_type] += 1
+            else:
+                stale.append(feature_type)
+            
+            # The sources are hashed only for the entries (re)written here, i.e. new, stale
+            # or with a changed size or mtime, once per patch
+            if not up_to_date or entry['files'] != files:
+                image_hash = image_hash or source_hash(image)
+                manifests[feature_type][name] = {'files': files, 'hash': image_hash, 'params': params}
+        
+        if stale:
+            tasks.append((image, stale))
+    
+    for feature_type in types:
+        print('%s: skipped %d up-to-date patches, %d to generate' % (feature_type, skipped[feature_type], len(patches) - skipped[feature_type]))
+    
+    return tasks, manifests
+
+def record_tasks(manifests, tasks, options):
+    # Manifest entries of the outputs generated by a full (not incremental) run,
+    # so that a later incremental run does not keep outputs of other parameters.
+    # Full runs skip the hash (it would read every source again): only size and mtime are
+    # recorded, so a later incremental run regenerates the patches whose sources were touched
+    for image, image_types in tasks:
+        files = source_files(image)
+        
+        for feature_type in image_types:
+            manifests[feature_type][os.path.basename(image)] = {'files': files, 'hash': None, 'params': feature_params(feature_type, options)}
 
 def main(options):
     patches = glob(os.path.join(options['path'], 'patches', '*/*.tif'))
     patches = [p for p in patches if ('_cl.tif' not in p) and ('_conf.tif' not in p)]
     
-    if options['type']=='indices':
+    types = feature_types if options['type']=='all' else options['type'].split(',')
+    
+    assert set(types) <= set(feature_types), "Wrong Type, select among " + ', '.join(feature_types)
+    
+    if options['incremental']:
+        tasks, manifests = incremental_tasks(patches, types, options)
+    else:
+        tasks = [(image, types) for image in patches]
+        manifests = {feature_type: load_manifest(options['path'], feature_type) for feature_type in types}
+    
+    # Patches are sent to the workers in batches of batch_size to amortize the per-task overhead
+    batch_size = options['batch_size'] if options['batch_size'] == 'auto' else int(options['batch_size'])
+    parallel = ProgressParallel(total = len(tasks), n_jobs = options['n_jobs'], batch_size = batch_size)
+    
+    if len(types) > 1:
+        
+        # All the requested features of a patch in one task
+        parallel(delayed(fused)(image, image_types, options) for image, image_types in tasks)
+        
+    elif types[0]=='indices':
         
-        for image in tqdm(patches):
-            indices(image)
+        parallel(delayed(indices)(image, options['indices_engine'], options['labels']) for image, _ in tasks)
             
-    elif options['type']=='texture':
+    elif types[0]=='texture':
         
-        Parallel(n_jobs=options['n_jobs'])(delayed(texture)(image, options['window_size'], options['max_value']) for image in tqdm(patches))
+        parallel(delayed(texture)(image, options['window_size'], options['max_value'], options['glcm_engine'], options['tile_size'], options['labels']) for image, _ in tasks)
         
-    elif options['type']=='spatial':
+    elif types[0]=='spatial':
         
-        Parallel(n_jobs=options['n_jobs'])(delayed(spatial)(image, 1, 16) for image in tqdm(patches))
+        parallel(delayed(spatial)(image, 1, 16, options['labels']) for image, _ in tasks)
     
-    elif options['type']=='lbp':
+    elif types[0]=='lbp':
         
-        Parallel(n_jobs=options['n_jobs'])(delayed(lbp)(image, options['radius'], options['n_points']) for image in tqdm(patches))
-        
-    else:
-        raise AssertionError("Wrong Type, select indices or texture")
+        parallel(delayed(lbp)(image, options['radius'], options['n_points'], options['labels']) for image, _ in tasks)
+    
+    # Every run records what it generated (also the full runs)
+    if not options['incremental']:
+        record_tasks(manifests, tasks, options)
+    
+    for feature_type in types:
+        save_manifest(options['path'], feature_type, manifests[feature_type])
             
 if __name__ == "__main__":
 
@@ -327,12 +696,20 @@ if __name__ == "__main__":
 
     # Options
     parser.add_argument('--path', default=os.path.join(root_path, 'data'), help='Path to dataset')
-    parser.add_argument('--type', default='indices', type=str, help=' Select between indices or texture or spatial or lbp')
+    parser.add_argument('--type', default='indices', type=str, help=' Select between indices or texture or spatial or lbp, a comma separated list of them or all (each patch is read once)')
     parser.add_argument('--n_jobs', default= -2, type=int, help='How many cores?')
+    parser.add_argument('--batch_size', default= 'auto', type=str, help='Number of patches sent at once to each worker (or auto)')
+    parser.add_argument('--labels', default= 'copy', type=str, choices=['copy', 'hardlink', 'symlink', 'none'], help='How the _cl.tif and _conf.tif are placed next to the features (none: use --label_root of spectral_extraction.py)')
+    parser.add_argument('--incremental', action='store_true', help='Generate only the missing patches or those whose source files or feature parameters (including --labels) changed since the last run')
     
+    # Indices options
+    parser.add_argument('--indices_engine', default= 'reference', type=str, choices=['reference', 'fused'], help='Indices computation: band by band (reference) or with a single read and write of all the indices (fused)')
+
     # GLCM options
     parser.add_argument('--window_size', default= 13, type=int, help='Size of the sliding window for the GLCM (use an odd number)')
     parser.add_argument('--max_value', default= 16, type=int, help=' Number of bins-levels for image quantization for the GLCM (use a power of two)')
+    parser.add_argument('--glcm_engine', default= 'reference', type=str, choices=list(glcm_engines), help='GLCM computation: per window with scikit-image (reference), for all windows at once (vectorized) or with a running histogram along rows (rolling)')
+    parser.add_argument('--tile_size', default= 256, type=int, help='Size of the tiles the GLCM is computed and written on (bounds the memory of the features on large rasters)')
 
     # LBP options
     parser.add_argument('--radius', default= 3, type=int, help='Radius of circle (spatial resolution of the operator)')
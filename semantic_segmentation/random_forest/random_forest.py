@@ -4,11 +4,15 @@ Created on Mon Jun  7 14:44:24 2021
 
 @author: gkako
 """
+import re
 import numpy as np
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
+from sklearn import __version__
 from sklearn.ensemble import RandomForestClassifier
 
+sklearn_version = tuple(int(v) for v in re.match(r'(\d+)\.(\d+)', __version__).groups())
+
 # Useful only for producing predicted masks (fill nan values)
 bands_mean = np.array([0.05197577, 0.04783991, 0.04056812, 0.03163572, 0.02972606, 0.03457443,
  0.03875053, 0.03436435, 0.0392113,  0.02358126, 0.01588816]).astype('float32')
@@ -24,4 +28,36 @@ random_forest=RandomForestClassifier(n_estimators = 125,
                                      random_state=5,
                                      n_jobs=-1)
 
-rf_classifier = Pipeline(steps=[('scaler', StandardScaler()), ('rf', random_forest)], verbose = 4) 
\ No newline at end of file
+rf_classifier = Pipeline(steps=[('scaler', StandardScaler()), ('rf', random_forest)], verbose = 4) 
+
+# Histogram-based Gradient Boosting Initialization
+# Built only when --model hgb is selected, so the rf path does not depend on it.
+# The 25 features are not pre-binned here: the estimator quantizes them itself into
+# at most max_bins=255 bins (uint8 bin indices), and nan values are handled natively.
+def hgb_classifier():
+    
+    if sklearn_version < (1, 0):
+        # Experimental in scikit-learn < 1.0
+        from sklearn.experimental import enable_hist_gradient_boosting # noqa: F401
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    
+    params = dict(max_iter = 100,
+                  learning_rate=0.1,
+                  max_leaf_nodes=63,
+                  min_samples_leaf=20,
+                  max_bins=255,
+                  early_stopping=False,
+                  random_state=5)
+    
+    # class_weight exists from scikit-learn 1.2, before that train_eval.py
+    # balances the classes through the sample weights
+    if sklearn_version >= (1, 2):
+        params['class_weight'] = 'balanced'
+    
+    return Pipeline(steps=[('hgb', HistGradientBoostingClassifier(**params))], verbose = 4)
+
+# Model backends of train_eval.py (--model)
+def get_classifier(model):
+    if model == 'hgb':
+        return hgb_classifier()
+    return rf_classifier
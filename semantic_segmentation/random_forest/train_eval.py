@@ -20,14 +20,21 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from joblib import dump
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from sklearn.tree._tree import Tree
+from sklearn.utils import check_random_state
+from sklearn.utils.class_weight import compute_sample_weight
+from concurrent.futures import ThreadPoolExecutor
 from os.path import dirname as up
 
 sys.path.append(up(os.path.abspath(__file__)))
-from random_forest import rf_classifier, bands_mean
+from random_forest import get_classifier, bands_mean
+from compiled_forest import export_onnx, OnnxForest
 
 sys.path.append(os.path.join(up(up(up(os.path.abspath(__file__)))), 'utils'))
 from metrics import confusion_matrix
-from assets import conf_mapping, rf_features, cat_mapping_vec
+from assets import conf_mapping, rf_features, encode_labels
 
 random.seed(0)
 np.random.seed(0)
@@ -42,175 +49,426 @@ logging.info('*'*10)
 # Training                                                    #
 ###############################################################
 
-def main(options):
+# Keys of a pixel in the feature stores
+feature_keys = ['Date', 'Tile', 'Image', 'XCoords', 'YCoords']
+
+def load_hdf5(path, split):
+    # Load Spectral Signatures, Spectral Indices and GLCM texture features of a split
+    with pd.HDFStore(os.path.join(path, 'dataset.h5'), mode = 'r') as hdf_ss:
+        df_ss = hdf_ss.select(split)
     
-    # Load Spectral Signatures, Spectral Indices and GLCM texture features
-    hdf_ss = pd.HDFStore(os.path.join(options['path'], 'dataset.h5'), mode = 'r')
-    df_train_ss = hdf_ss.select('train')
-    df_val_ss = hdf_ss.select('val')
-    df_test_ss = hdf_ss.select('test')
-    hdf_ss.close()
+    with pd.HDFStore(os.path.join(path, 'dataset_si.h5'), mode = 'r') as hdf_si:
+        df_si = hdf_si.select(split)
     
-    hdf_si = pd.HDFStore(os.path.join(options['path'], 'dataset_si.h5'), mode = 'r')
-    df_train_si = hdf_si.select('train')
-    df_val_si = hdf_si.select('val')
-    df_test_si = hdf_si.select('test')
-    hdf_si.close()
+    with pd.HDFStore(os.path.join(path, 'dataset_glcm.h5'), mode = 'r') as hdf_glcm:
+        df_glcm = hdf_glcm.select(split)
     
-    hdf_glcm = pd.HDFStore(os.path.join(options['path'], 'dataset_glcm.h5'), mode = 'r')
-    df_train_glcm = hdf_glcm.select('train')
-    df_val_glcm = hdf_glcm.select('val')
-    df_test_glcm = hdf_glcm.select('test')
-    hdf_glcm.close()
+    # spectral_extraction.py writes the three stores from the patches sorted on the same key
+    # (date, tile, crop), so the features are aligned positionally once the keys are verified
+    if keys_aligned(df_ss, df_si) and keys_aligned(df_ss, df_glcm):
+        df = positional_join(df_ss, df_si, '_si')
+        df = positional_join(df, df_glcm, '_glcm')
+    else:
+        # Stores extracted in different orders (e.g. before the shared sort key), slow but correct
+        print('Warning: keys of the ' + split + ' split are not aligned, falling back to merge (re-extract the stores with spectral_extraction.py)')
+        logging.warning('Keys of the ' + split + ' split are not aligned, falling back to merge (re-extract the stores with spectral_extraction.py)')
+        
+        # Join the ss, si and glcm features
+        df = df_ss.merge(df_si, left_on=feature_keys, right_on=feature_keys, suffixes=('', '_si'))
+        df = df.merge(df_glcm, left_on=feature_keys, right_on=feature_keys, suffixes=('', '_glcm'))
     
-    # Join for each split the ss, si and glcm features
-    df_train = df_train_ss.merge(df_train_si, left_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], 
-                                 right_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], suffixes=('', '_si'))
+    return df
 
-    df_val = df_val_ss.merge(df_val_si, left_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], 
-                                 right_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], suffixes=('', '_si'))
+def keys_checksum(df):
+    # Per-row hash of the key columns (vectorized, no join)
+    return pd.util.hash_pandas_object(df[feature_keys], index=False).values
 
-    df_test = df_test_ss.merge(df_test_si, left_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], 
-                                 right_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], suffixes=('', '_si'))
+def keys_aligned(df_left, df_right):
+    return len(df_left) == len(df_right) and np.array_equal(keys_checksum(df_left), keys_checksum(df_right))
+
+def positional_join(df_left, df_right, suffix):
+    # Same columns as df_left.merge(df_right, on=feature_keys, suffixes=('', suffix))
+    # for aligned stores: the non-key columns of df_right are appended positionally
+    right_columns = [c for c in df_right.columns if c not in feature_keys]
+    
+    df = df_left.reset_index(drop=True)
+    df_right = df_right[right_columns].reset_index(drop=True)
+    df_right.columns = [c + suffix if c in df.columns else c for c in right_columns]
     
-    df_train = df_train.merge(df_train_glcm, left_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], 
-                                 right_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], suffixes=('', '_glcm'))
+    return pd.concat([df, df_right], axis=1)
+
+def load_parquet(path, split, columns):
+    # Load only the given columns of a split from the Parquet feature store
+    # (spectral_extraction.py --type all --format parquet)
+    return pd.read_parquet(os.path.join(path, 'dataset_all.parquet'), columns = columns, filters = [('split', '=', split)])
 
-    df_val = df_val.merge(df_val_glcm, left_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], 
-                                 right_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], suffixes=('', '_glcm'))
+###############################################################
+# Streaming training                                          #
+###############################################################
 
-    df_test = df_test.merge(df_test_glcm, left_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], 
-                                 right_on=['Date', 'Tile', 'Image', 'XCoords', 'YCoords'], suffixes=('', '_glcm'))
+def count_rows(options, split):
+    # Number of pixels of a split in the feature store
+    if options['feature_store'] == 'parquet':
+        import pyarrow.dataset as ds
+        
+        dataset = ds.dataset(os.path.join(options['path'], 'dataset_all.parquet'), format = 'parquet', partitioning = 'hive')
+        return dataset.count_rows(filter = ds.field('split') == split)
     
-    # Calculate weights for each sample on Train/ Val splits based on Confidence Level
-    df_train['Weight'] = 1/df_train['Confidence'].apply(lambda x: conf_mapping[x])
+    with pd.HDFStore(os.path.join(options['path'], 'dataset.h5'), mode = 'r') as hdf_ss:
+        return hdf_ss.get_storer(split).nrows
+
+def feature_chunks(options, split, random_state = None):
+    # Chunks of train_chunk_size pixels of a split with the rf_features, Class and Confidence.
+    # The store is sorted by split, tile and date, so the chunks are made of blocks (row groups
+    # of the parquet dataset, shuffle_block_size rows of the hdf5 stores) taken across the whole
+    # split in random order, not of contiguous rows of a few scenes
+    random_state = check_random_state(random_state)
+    columns = rf_features + ['Class', 'Confidence']
     
-    # Aggregate classes to Water Super class
-    for agg_class in options['agg_to_water']:
-        df_train.loc[df_train['Class'] == agg_class, 'Class'] = 'Marine Water'
-        df_val.loc[df_val['Class'] == agg_class, 'Class'] = 'Marine Water'
-        df_test.loc[df_test['Class'] == agg_class, 'Class'] = 'Marine Water'
+    if options['feature_store'] == 'parquet':
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        
+        dataset = ds.dataset(os.path.join(options['path'], 'dataset_all.parquet'), format = 'parquet', partitioning = 'hive')
+        
+        row_groups = [row_group for fragment in dataset.get_fragments(filter = ds.field('split') == split)
+                      for row_group in fragment.split_by_row_group()]
+        
+        # Regroup the row groups, in random order, in chunks of train_chunk_size
+        batches, n_rows = [], 0
+        for j in random_state.permutation(len(row_groups)):
+            table = row_groups[j].to_table(schema = dataset.schema, columns = columns)
+            batches += table.to_batches()
+            n_rows += table.num_rows
+            
+            while n_rows >= options['train_chunk_size']:
+                table = pa.Table.from_batches(batches)
+                yield table.slice(0, options['train_chunk_size']).to_pandas()
+                
+                batches = table.slice(options['train_chunk_size']).to_batches()
+                n_rows -= options['train_chunk_size']
+        
+        if n_rows > 0:
+            yield pa.Table.from_batches(batches).to_pandas()
+        return
+    
+    with pd.HDFStore(os.path.join(options['path'], 'dataset.h5'), mode = 'r') as hdf_ss, \
+         pd.HDFStore(os.path.join(options['path'], 'dataset_si.h5'), mode = 'r') as hdf_si, \
+         pd.HDFStore(os.path.join(options['path'], 'dataset_glcm.h5'), mode = 'r') as hdf_glcm:
+        
+        block_size = options['shuffle_block_size']
+        starts = random_state.permutation(np.arange(0, hdf_ss.get_storer(split).nrows, block_size))
+        
+        # Regroup the blocks, in random order, in chunks of train_chunk_size
+        blocks, n_rows = [], 0
+        for start in starts:
+            df_ss = hdf_ss.select(split, start = start, stop = start + block_size)
+            df_si = hdf_si.select(split, start = start, stop = start + block_size)
+            df_glcm = hdf_glcm.select(split, start = start, stop = start + block_size)
+            
+            if not (keys_aligned(df_ss, df_si) and keys_aligned(df_ss, df_glcm)):
+                raise AssertionError("Wrong feature stores, dataset.h5, dataset_si.h5 and dataset_glcm.h5 are not aligned (extract them again with spectral_extraction.py)")
+            
+            blocks.append(positional_join(positional_join(df_ss, df_si, '_si'), df_glcm, '_glcm'))
+            n_rows += len(blocks[-1])
+            
+            while n_rows >= options['train_chunk_size']:
+                df = pd.concat(blocks)
+                yield df.iloc[:options['train_chunk_size']]
+                
+                blocks = [df.iloc[options['train_chunk_size']:]]
+                n_rows -= options['train_chunk_size']
+        
+        if n_rows > 0:
+            yield pd.concat(blocks)
+
+def chunk_arrays(df, agg_to_water):
+    # float32 features, classes and confidence weights of a chunk
+    weight = 1/df['Confidence'].map(conf_mapping).astype(int).values
+    
+    y = np.array(df['Class'].astype(object))
+    y[np.isin(y, agg_to_water)] = 'Marine Water'               # Aggregate classes to Water Super class
+    
+    return df[rf_features].to_numpy(dtype = np.float32), y, weight
+
+def expand_classes(estimator, sub_classes, classes):
+    # Tree of a sub-forest (leaf values over sub_classes) with its leaf values over all the
+    # classes of the forest. As in any forest, the tree classes are the indices of the classes
+    state = estimator.tree_.__getstate__()
+    
+    values = np.zeros(state['values'].shape[:2] + (len(classes),))
+    values[:, :, np.searchsorted(classes, sub_classes)] = state['values']
+    state['values'] = values
+    
+    estimator.tree_ = Tree(estimator.n_features_in_, np.array([len(classes)], dtype = np.intp), 1)
+    estimator.tree_.__setstate__(state)
+    
+    estimator.classes_ = np.arange(len(classes), dtype = np.float64)
+    estimator.n_classes_ = len(classes)
     
-    # Keep selected features and transform to numpy array
-    X_train = df_train[rf_features].values
-    y_train = df_train['Class'].values
-    weight_train = df_train['Weight'].values
+    return estimator
+
+def fit_streaming(options, classifier):
+    # Out-of-core training of Pipeline(StandardScaler, RandomForestClassifier):
+    # the scaler is fitted on a first pass over the chunks and each chunk then
+    # trains a sub-forest (trees proportional to its size), merged at the end.
+    # Memory is bounded by train_chunk_size. Each sub-forest only sees its chunk, so more
+    # chunks cost accuracy (on scene-structured synthetic data, 0.6 points for 8 chunks and
+    # 1.2 points for 16, against 1.7 and 2.9 points with chunks of contiguous rows)
+    scaler = clone(classifier.named_steps['scaler'])
+    forest = classifier.named_steps['rf']
+    
+    # Seeds of the order of the blocks and of the sub-forests (random_state may be None)
+    random_state = check_random_state(forest.random_state)
+    shuffle_seed = random_state.randint(np.iinfo(np.int32).max)
     
-    if options['eval_set'] == 'test':
-        X_test = df_test[rf_features].values
-        y_test = df_test['Class'].values
+    classes = set()
+    n_rows = 0
+    for df in feature_chunks(options, 'train', shuffle_seed):
+        X, y, _ = chunk_arrays(df, options['agg_to_water'])
         
-    elif options['eval_set'] == 'val':
-        X_test = df_val[rf_features].values
-        y_test = df_val['Class'].values
+        scaler.partial_fit(X)
+        classes.update(y)
+        n_rows += len(X)
+    
+    classes = np.array(sorted(classes), dtype = object)
+    
+    estimators = []
+    for i, df in enumerate(feature_chunks(options, 'train', shuffle_seed)):
         
-    else:
-        raise
+        start_time = time.time()
+        X, y, weight = chunk_arrays(df, options['agg_to_water'])
+        
+        # The out-of-bag score needs the whole train set
+        n_trees = max(1, int(round(forest.n_estimators*len(X)/n_rows)))
+        sub_forest = clone(forest).set_params(n_estimators = n_trees, oob_score = False, random_state = random_state.randint(np.iinfo(np.int32).max))
+        sub_forest.fit(scaler.transform(X), y, sample_weight = weight)
+        
+        estimators += [expand_classes(estimator, sub_forest.classes_, classes) for estimator in sub_forest.estimators_]
+        
+        elapsed = time.time() - start_time
+        print('Chunk %d: %d pixels, %d trees, %.0f pixels/second' % (i, len(X), n_trees, len(X)/elapsed))
+        logging.info('Chunk %d: %d pixels, %d trees, %.0f pixels/second' % (i, len(X), n_trees, len(X)/elapsed))
+    
+    # Merge the sub-forests
+    sub_forest.set_params(n_estimators = len(estimators))
+    sub_forest.estimators_ = estimators
+    sub_forest.classes_ = classes
+    sub_forest.n_classes_ = len(classes)
+    
+    return Pipeline(steps=[('scaler', scaler), ('rf', sub_forest)])
+
+###############################################################
+# Prediction of masks                                         #
+###############################################################
+
+def read_roi_features(path, roi):
+    # Load the image patch, its indices and texture as a (pixels, features) array
+    roi_folder = '_'.join(['S2'] + roi.split('_')[:-1])             # Get Folder Name
+    roi_name = '_'.join(['S2'] + roi.split('_'))                    # Get File Name
+    roi_file = os.path.join(path, 'patches', roi_folder,roi_name + '.tif')     # Get File path
+    
+    with rasterio.open(roi_file, mode ='r') as src:
+        tags = src.tags().copy()
+        meta = src.meta
+        image = src.read()
+        dtype = src.dtypes[0]
+    
+    # Update meta to reflect the number of layers
+    meta.update(count = 1)
+    
+    # Preprocessing
+    # Fill image nan with mean
+    image_features = np.reshape(image, (image.shape[0], -1)).T
+    image_features = np.where(np.isnan(image_features), bands_mean, image_features)
+    
+    # Load Indices
+    si_filename = os.path.join(path, 'indices', roi_folder,roi_name + '_si.tif')
+    with rasterio.open(si_filename, mode ='r') as src:
+        image_si = src.read()
+        si_image_features = np.nan_to_num(np.reshape(image_si, (image_si.shape[0], -1)).T)
+    
+    # Load Texture
+    glcm_filename = os.path.join(path, 'texture', roi_folder,roi_name + '_glcm.tif')
+    with rasterio.open(glcm_filename, mode ='r') as src:
+        image_glcm = src.read()
+        glcm_image_features = np.nan_to_num(np.reshape(image_glcm, (image_glcm.shape[0], -1)).T)
     
-    print('Number of Input features: ', X_train.shape[1])
-    print('Train: ',X_train.shape[0])
-    print('Test: ',X_test.shape[0])
+    # Concatenate all features
+    image_features = np.concatenate([image_features, si_image_features, glcm_image_features], axis=1)
     
-    logging.info('Number of Input features: ' + str(X_train.shape[1]))
-    logging.info('Train: ' + str(X_train.shape[0]))
-    logging.info('Test: ' + str(X_test.shape[0]))
+    return meta, tags, dtype, image.shape[1:], image_features
+
+def predict_chunks(classifier, features, chunk_size):
+    # Bound the memory of the classifier by predicting fixed-size chunks.
+    # The classes are encoded once, so the predictions are cat_mapping codes
+    # (same as classifier.predict, without class names per pixel)
+    class_codes = encode_labels(classifier.classes_)
+    predictions = np.empty(features.shape[0], dtype = class_codes.dtype)
+    
+    for start in range(0, features.shape[0], chunk_size):
+        probs = classifier.predict_proba(features[start:start + chunk_size])
+        predictions[start:start + chunk_size] = class_codes[probs.argmax(1)]
+    
+    return predictions
+
+def write_mask(output_image, meta, tags, dtype, predicted_labels):
+    with rasterio.open(output_image, 'w', **meta) as dst:
         
-    # Training
-    print('Started training')
-    logging.info('Started training')
+        dst.write_band(1, predicted_labels.astype(dtype)) # In order to be in the same dtype
+        
+        dst.update_tags(**tags)
+
+###############################################################
+# Main                                                        #
+###############################################################
+
+def main(options):
+    
+    if options['eval_set'] not in ['val', 'test']:
+        raise AssertionError("Wrong eval_set, select val or test")
+    
+    if options['predictor'] == 'onnx' and options['model'] != 'rf':
+        raise AssertionError("Wrong predictor, onnx is available only for the rf model")
+    
+    if options['streaming'] and options['model'] != 'rf':
+        raise AssertionError("Wrong model, streaming training is available only for the rf model")
+    
+    classifier = get_classifier(options['model'])
     
-    start_time = time.time()
-    rf_classifier.fit(X_train, y_train, **dict(rf__sample_weight=weight_train))
+    # Load Spectral Signatures, Spectral Indices and GLCM texture features of the evaluation set
+    if options['feature_store'] == 'parquet':
+        df_eval = load_parquet(options['path'], options['eval_set'], rf_features + ['Class'])
+    else:
+        df_eval = load_hdf5(options['path'], options['eval_set'])
+    
+    # Aggregate classes to Water Super class
+    for agg_class in options['agg_to_water']:
+        df_eval.loc[df_eval['Class'] == agg_class, 'Class'] = 'Marine Water'
+    
+    X_test = df_eval[rf_features].to_numpy(dtype = np.float32)
+    y_test = df_eval['Class'].values
+    
+    if options['streaming']:
+        
+        print('Number of Input features: ', len(rf_features))
+        print('Train: ', count_rows(options, 'train'))
+        print('Test: ',X_test.shape[0])
+        
+        logging.info('Number of Input features: ' + str(len(rf_features)))
+        logging.info('Train: ' + str(count_rows(options, 'train')))
+        logging.info('Test: ' + str(X_test.shape[0]))
+        
+        # Training chunk by chunk, the train split is never loaded as a whole
+        print('Started streaming training')
+        logging.info('Started streaming training')
+        
+        start_time = time.time()
+        classifier = fit_streaming(options, classifier)
+        
+    else:
+        
+        # Load Spectral Signatures, Spectral Indices and GLCM texture features of the train set
+        if options['feature_store'] == 'parquet':
+            df_train = load_parquet(options['path'], 'train', rf_features + ['Class', 'Confidence'])
+        else:
+            df_train = load_hdf5(options['path'], 'train')
+        
+        # Calculate weights for each sample on Train/ Val splits based on Confidence Level
+        df_train['Weight'] = 1/df_train['Confidence'].map(conf_mapping).astype(int)
+        
+        # Aggregate classes to Water Super class
+        for agg_class in options['agg_to_water']:
+            df_train.loc[df_train['Class'] == agg_class, 'Class'] = 'Marine Water'
+        
+        # Keep selected features and transform to numpy array (float32 as the rasters,
+        # the scaler and the forest keep it, so there is no upcast copy)
+        X_train = df_train[rf_features].to_numpy(dtype = np.float32)
+        y_train = df_train['Class'].values
+        weight_train = df_train['Weight'].values
+        
+        # Balanced classes through the sample weights when the estimator has no class_weight
+        if classifier.steps[-1][1].get_params().get('class_weight', None) is None:
+            weight_train = weight_train*compute_sample_weight('balanced', y_train)
+        
+        print('Number of Input features: ', X_train.shape[1])
+        print('Train: ',X_train.shape[0])
+        print('Test: ',X_test.shape[0])
+        
+        logging.info('Number of Input features: ' + str(X_train.shape[1]))
+        logging.info('Train: ' + str(X_train.shape[0]))
+        logging.info('Test: ' + str(X_test.shape[0]))
+            
+        # Training
+        print('Started training')
+        logging.info('Started training')
+        
+        start_time = time.time()
+        classifier.fit(X_train, y_train, **{classifier.steps[-1][0] + '__sample_weight': weight_train})
     
     print("Training finished after %s seconds" % (time.time() - start_time))
     logging.info("Training finished after %s seconds" % (time.time() - start_time))
     
-    cl_path = os.path.join(up(os.path.abspath(__file__)), 'rf_classifier.joblib')
-    dump(rf_classifier, cl_path)
+    cl_path = os.path.join(up(os.path.abspath(__file__)), options['model'] + '_classifier.joblib')
+    dump(classifier, cl_path)
     print("Classifier is saved at: " +str(cl_path))
     logging.info("Classifier is saved at: " +str(cl_path))
     
-    print('\t\t Random Forest Results on '+options['eval_set']+' Set')
-    conf_mat = confusion_matrix(y_test, rf_classifier.predict(X_test), rf_classifier.classes_)
+    model_name = 'Random Forest' if options['model'] == 'rf' else 'Gradient Boosting'
+    print('\t\t '+model_name+' Results on '+options['eval_set']+' Set')
+    conf_mat = confusion_matrix(y_test, classifier.predict(X_test), classifier.classes_)
     logging.info("Confusion Matrix:  \n" + str(conf_mat.to_string()))
     print("Confusion Matrix:  \n" + str(conf_mat.to_string()))
     
     if options['predict_masks']:
-    
-        path = os.path.join(options['path'], 'patches')
-        ROIs = np.genfromtxt(os.path.join(options['path'], 'splits', 'test_X.txt'),dtype='str')
         
-        impute_nan = np.tile(bands_mean, (256,256,1))
-                    
-        for roi in tqdm(ROIs):
+        os.makedirs(options['gen_masks_path'], exist_ok=True)
         
-            roi_folder = '_'.join(['S2'] + roi.split('_')[:-1])             # Get Folder Name
-            roi_name = '_'.join(['S2'] + roi.split('_'))                    # Get File Name
-            roi_file = os.path.join(path, roi_folder,roi_name + '.tif')     # Get File path
+        if options['predictor'] == 'onnx':
+            # Compiled tree ensemble (StandardScaler folded into the thresholds)
+            onnx_path = export_onnx(classifier, cl_path.replace('.joblib', '.onnx'))
+            print("Compiled classifier is saved at: " +str(onnx_path))
+            logging.info("Compiled classifier is saved at: " +str(onnx_path))
+            
+            classifier = OnnxForest(onnx_path)
         
-            os.makedirs(options['gen_masks_path'], exist_ok=True)
+        ROIs = np.genfromtxt(os.path.join(options['path'], 'splits', 'test_X.txt'),dtype='str')
+        batches = [ROIs[i:i + options['predict_batch']] for i in range(0, len(ROIs), options['predict_batch'])]
         
-            output_image = os.path.join(options['gen_masks_path'], os.path.basename(roi_file).split('.tif')[0] + '_rf.tif')
-            
-            # Load the image patch and metadata
-            with rasterio.open(roi_file, mode ='r') as src:
-                tags = src.tags().copy()
-                meta = src.meta
-                image = src.read()
-                image = np.moveaxis(image, (0, 1, 2), (2, 0, 1))
-                dtype = src.read(1).dtype
-        
-            # Update meta to reflect the number of layers
-            meta.update(count = 1)
-            
-            # Preprocessing
-            # Fill image nan with mean
-            nan_mask = np.isnan(image)
-            image[nan_mask] = impute_nan[nan_mask]
+        start_time = time.time()
+        
+        # Reading and writing of the GeoTIFFs overlap with the prediction
+        with ThreadPoolExecutor(max_workers = options['io_workers']) as pool:
             
-            sz1 = image.shape[0]
-            sz2 = image.shape[1]
-            image_features = np.reshape(image, (sz1*sz2, -1))
+            reads = [pool.submit(read_roi_features, options['path'], roi) for roi in batches[0]]
+            writes = []
             
-            # Load Indices
-            si_filename = os.path.join(options['path'], 'indices', roi_folder,roi_name + '_si.tif')
-            with rasterio.open(si_filename, mode ='r') as src:
-                image_si = src.read()
-                image_si = np.moveaxis(image_si, (0, 1, 2), (2, 0, 1))
+            for i in tqdm(range(len(batches))):
                 
-                si_sz1 = image_si.shape[0]
-                si_sz2 = image_si.shape[1]
-                si_image_features = np.reshape(image_si, (si_sz1*si_sz2, -1))
-
-                si_image_features = np.nan_to_num(si_image_features)
-            
-            # Load Texture
-            glcm_filename = os.path.join(options['path'], 'texture', roi_folder,roi_name + '_glcm.tif')
-            with rasterio.open(glcm_filename, mode ='r') as src:
-                image_glcm = src.read()
-                image_glcm = np.moveaxis(image_glcm, (0, 1, 2), (2, 0, 1))
+                patches = [read.result() for read in reads]
                 
-                glcm_sz1 = image_glcm.shape[0]
-                glcm_sz2 = image_glcm.shape[1]
-                glcm_image_features = np.reshape(image_glcm, (glcm_sz1*glcm_sz2, -1))
-
-                glcm_image_features = np.nan_to_num(glcm_image_features)
+                # Prefetch the next batch
+                if i + 1 < len(batches):
+                    reads = [pool.submit(read_roi_features, options['path'], roi) for roi in batches[i + 1]]
                 
-            # Concatenate all features
-            image_features = np.concatenate([image_features, si_image_features, glcm_image_features], axis=1)  
-        
-            # Write it
-            with rasterio.open(output_image, 'w', **meta) as dst:
+                # Stack the features of the whole batch and predict them chunk by chunk
+                predictions = predict_chunks(classifier, np.concatenate([patch[-1] for patch in patches]), options['chunk_size'])
                 
-                # use classifier to predict labels for the whole image
-                predictions = rf_classifier.predict(image_features)  
-    
-                predicted_labels = np.reshape(predictions, (sz1,sz2))
-    
-                class_ind = cat_mapping_vec(predicted_labels).astype(dtype).copy()
-                dst.write_band(1, class_ind) # In order to be in the same dtype
-    
-                dst.update_tags(**tags)
+                # Scatter the predictions back to per-patch masks
+                offset = 0
+                for roi, (meta, tags, dtype, shape, features) in zip(batches[i], patches):
+                    
+                    output_image = os.path.join(options['gen_masks_path'], '_'.join(['S2'] + roi.split('_')) + '_' + options['model'] + '.tif')
+                    predicted_labels = np.reshape(predictions[offset:offset + len(features)], shape)
+                    writes.append(pool.submit(write_mask, output_image, meta, tags, dtype, predicted_labels))
+                    
+                    offset += len(features)
+            
+            for write in writes:
+                write.result()
+        
+        print("Masks generated after %s seconds" % (time.time() - start_time))
+        logging.info("Masks generated after %s seconds" % (time.time() - start_time))
     
 if __name__ == "__main__":
 
@@ -220,11 +478,20 @@ if __name__ == "__main__":
 
     # Evaluation/Checkpointing
     parser.add_argument('--path', default=os.path.join(root_path, 'data'), help='Path to dataset')
+    parser.add_argument('--model', default='rf', type=str, choices=['rf', 'hgb'], help='Random Forest or Histogram-based Gradient Boosting (features binned internally into 255 uint8 bins)')
+    parser.add_argument('--streaming', action='store_true', help='Train the rf model chunk by chunk from the feature store (out-of-core)')
+    parser.add_argument('--train_chunk_size', default= 1000000, type=int, help='Number of train pixels per chunk of the streaming training')
+    parser.add_argument('--shuffle_block_size', default= 4096, type=int, help='Number of contiguous hdf5 rows per block, the chunks of the streaming training are made of blocks from across the train split')
+    parser.add_argument('--feature_store', default='hdf5', type=str, choices=['hdf5', 'parquet'], help='Load the features from the three hdf5 files or from the Parquet dataset (dataset_all.parquet)')
 
     # Produce Predicted Masks
     parser.add_argument('--eval_set', default='test', type=str, help="Set for the evaluation 'val' or 'test' for final testing")
     parser.add_argument('--predict_masks', default= True, type=bool, help='Generate test set prediction masks?')
     parser.add_argument('--gen_masks_path', default=os.path.join(root_path, 'data', 'predicted_rf'), help='Path to where to produce store predictions')
+    parser.add_argument('--predict_batch', default= 16, type=int, help='Number of patches whose features are stacked and predicted together')
+    parser.add_argument('--chunk_size', default= 262144, type=int, help='Number of pixels per predict call (bounds the memory of the classifier)')
+    parser.add_argument('--io_workers', default= 4, type=int, help='Number of threads reading and writing the GeoTIFFs in the background')
+    parser.add_argument('--predictor', default='sklearn', type=str, choices=['sklearn', 'onnx'], help='Predict the masks with the scikit-learn pipeline or with its ONNX Runtime export (compiled_forest.py)')
 
     parser.add_argument('--agg_to_water', default='["Mixed Water", "Wakes", "Cloud Shadows", "Waves"]', type=str, help='Specify the Classes that will aggregate with Marine Water')
     
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+Author: Ioannis Kakogeorgiou
+Email: gkakogeorgiou@gmail.com
+Python Version: 3.7.10
+Description: benchmark_dataloader.py per-sample latency of GenDEBRIS.__getitem__ (CxHxW samples
+             with nan imputed at load time) against the previous sample path (HxWxC, per-sample
+             imputation and ToTensor) on synthetic patches.
+'''
+
+import os
+import sys
+import time
+import torch
+import random
+import shutil
+import argparse
+import tempfile
+import rasterio
+import numpy as np
+from os.path import dirname as up
+from rasterio.transform import from_origin
+import torchvision.transforms as transforms
+
+sys.path.append(up(os.path.abspath(__file__)))
+from dataloader import GenDEBRIS, load_roi, bands_mean, bands_std, RandomRotationTransform
+
+def synthetic_dataset(path, n_patches, size):
+    # 11-band float32 patches (with nan values) and _cl.tif masks, in the layout of MARIDA
+    rng = np.random.RandomState(0)
+    folder = os.path.join(path, 'patches', 'S2_1-1-20_00XXX')
+    os.makedirs(folder, exist_ok=True)
+    os.makedirs(os.path.join(path, 'splits'), exist_ok=True)
+
+    meta = {'driver': 'GTiff', 'height': size, 'width': size, 'count': 11, 'dtype': 'float32',
+            'crs': 'EPSG:32616', 'transform': from_origin(0, 0, 10, 10)}
+
+    ROIs = []
+    for i in range(n_patches):
+        image = os.path.join(folder, 'S2_1-1-20_00XXX_%d.tif' % i)
+
+        patch = rng.uniform(0.0, 0.15, (11, size, size)).astype('float32')
+        patch[:, :size//8, :size//8] = np.nan
+
+        with rasterio.open(image, 'w', **meta) as dst:
+            dst.write(patch)
+
+        with rasterio.open(image.split('.tif')[0] + '_cl.tif', 'w', **dict(meta, count = 1, dtype = 'uint8')) as dst:
+            dst.write(rng.randint(0, 16, (1, size, size)).astype('uint8'))
+
+        ROIs.append('1-1-20_00XXX_%d' % i)
+
+    np.savetxt(os.path.join(path, 'splits', 'train_X.txt'), ROIs, fmt='%s')
+
+def legacy_sample(img, target, impute_nan, transform, standardization):
+    # Previous GenDEBRIS.__getitem__
+    img = np.moveaxis(img, [0, 1, 2], [2, 0, 1]).astype('float32')       # CxWxH to WxHxC
+
+    nan_mask = np.isnan(img)
+    img[nan_mask] = impute_nan[nan_mask]
+
+    target = target[:,:,np.newaxis]
+    stack = np.concatenate([img, target], axis=-1).astype('float32') # In order to rotate-transform both mask and image
+
+    stack = transform(stack)
+
+    img = stack[:-1,:,:]
+    target = stack[-1,:,:].long()
+
+    return standardization(img), target
+
+def timed(sample, n_samples, repeats):
+    start_time = time.time()
+    for _ in range(repeats):
+        for index in range(n_samples):
+            random.seed(index)
+            torch.manual_seed(index)
+            sample(index)
+    return (time.time() - start_time)/(repeats*n_samples)
+
+def main(options):
+
+    path = tempfile.mkdtemp()
+
+    try:
+        synthetic_dataset(path, options['n_patches'], options['size'])
+
+        standardization = transforms.Normalize(bands_mean, bands_std)
+        rotation_flip = [RandomRotationTransform([-90, 0, 90, 180]), transforms.RandomHorizontalFlip()]
+
+        # Previous path: raw patches, HxWxC samples and ToTensor
+        raw = [load_roi(path, roi) for roi in np.genfromtxt(os.path.join(path, 'splits', 'train_X.txt'), dtype='str')]
+        impute_nan = np.tile(bands_mean, (options['size'], options['size'], 1))
+        legacy_transform = transforms.Compose([transforms.ToTensor()] + rotation_flip)
+
+        def legacy(index):
+            return legacy_sample(raw[index][0], raw[index][1], impute_nan, legacy_transform, standardization)
+
+        # Current path: CxHxW float32 samples, imputed at load time
+        dataset = GenDEBRIS('train', transform = transforms.Compose(rotation_flip), standardization = standardization, path = path)
+
+        def current(index):
+            return dataset[index]
+
+        for name, sample in [('legacy', legacy), ('current', current)]:
+            sample(0) # Warm-up
+            print('%-8s %dx%d %8.2f ms/sample' % (name, options['size'], options['size'], 1000*timed(sample, options['n_patches'], options['repeats'])))
+
+        # Same samples for the same random rotations and flips
+        max_difference = 0
+        for index in range(options['n_patches']):
+            random.seed(index)
+            torch.manual_seed(index)
+            img_legacy, target_legacy = legacy(index)
+
+            random.seed(index)
+            torch.manual_seed(index)
+            img, target = current(index)
+
+            max_difference = max(max_difference, (img_legacy - img).abs().max().item(), (target_legacy - target).abs().max().item())
+
+        print('Max absolute difference: ', max_difference)
+
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    # Options
+    parser.add_argument('--n_patches', default= 20, type=int, help='Number of synthetic patches')
+    parser.add_argument('--size', default= 256, type=int, help='Size of the synthetic patches')
+    parser.add_argument('--repeats', default= 5, type=int, help='Number of timed passes over the patches')
+
+    args = parser.parse_args()
+    options = vars(args)  # convert to ordinary dict
+
+    main(options)
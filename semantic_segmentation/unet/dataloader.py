@@ -9,6 +9,7 @@ Description: dataloader.py includes the appropriate data loader for
 
 import os
 import torch
+import argparse
 import random
 import numpy as np
 from tqdm import tqdm
@@ -36,62 +37,130 @@ bands_std = np.array([0.04725893, 0.04743808, 0.04699043, 0.04967381, 0.04946782
 ###############################################################
 dataset_path = os.path.join(up(up(up(__file__))), 'data')
 
+def load_roi(path, roi, agg_to_water = True):
+    # Load the patch (CxHxW) and its classification mask (categories from 0, -1 for not annotated)
+    
+    # Construct file and folder name from roi
+    roi_folder = '_'.join(['S2'] + roi.split('_')[:-1])               # Get Folder Name
+    roi_name = '_'.join(['S2'] + roi.split('_'))                      # Get File Name
+    roi_file = os.path.join(path, 'patches', roi_folder,roi_name + '.tif')       # Get File path
+    roi_file_cl = os.path.join(path, 'patches', roi_folder,roi_name + '_cl.tif') # Get Class Mask
+    
+    # Load Classsification Mask
+    ds = gdal.Open(roi_file_cl)
+    target = np.copy(ds.ReadAsArray().astype(np.int64))
+    
+    # Aggregation
+    if agg_to_water:
+        target[target==15]=7          # Mixed Water to Marine Water Class
+        target[target==14]=7          # Wakes to Marine Water Class
+        target[target==13]=7          # Cloud Shadows to Marine Water Class
+        target[target==12]=7          # Waves to Marine Water Class
+    
+    # Categories from 1 to 0
+    target = np.copy(target - 1)
+    ds=None                   # Close file
+    
+    # Load Patch
+    ds = gdal.Open(roi_file)
+    img = np.copy(ds.ReadAsArray())
+    ds=None
+    
+    return img, target
+
+def impute_nan(img):
+    # Fill the nan values of a CxHxW patch with the mean of each band (done once, at load time)
+    return np.where(np.isnan(img), bands_mean[:, np.newaxis, np.newaxis], img).astype(np.float32)
+
+def load_rois(path, mode):
+    if mode not in ['train', 'test', 'val']:
+        raise AssertionError("Wrong mode, select between train, val or test")
+    
+    return np.atleast_1d(np.genfromtxt(os.path.join(path, 'splits', mode + '_X.txt'),dtype='str'))
+
+def cache_files(cache_path, mode, agg_to_water = True):
+    # Patches, targets and ROIs of the cache of a split
+    return (os.path.join(cache_path, mode + '_X.npy'),
+            os.path.join(cache_path, mode + '_y' + ('_agg' if agg_to_water else '') + '.npy'),
+            os.path.join(cache_path, mode + '_rois.txt'))
+
+def build_cache(mode = 'train', path = dataset_path, cache_path = None, agg_to_water = True):
+    # One-time cache of a split as contiguous .npy files, loaded memory-mapped by GenDEBRIS:
+    # (N,11,H,W) float32 patches with nan already imputed and (N,H,W) int8 targets already aggregated
+    cache_path = cache_path or os.path.join(path, 'cache')
+    os.makedirs(cache_path, exist_ok=True)
+    
+    ROIs = load_rois(path, mode)
+    X_file, y_file, rois_file = cache_files(cache_path, mode, agg_to_water)
+    
+    X, y = None, None
+    for i, roi in enumerate(tqdm(ROIs, desc = 'Cache '+mode+' set')):
+        
+        img, target = load_roi(path, roi, agg_to_water)
+        
+        if X is None:
+            # Written to temporary files, so that an interrupted build is never loaded
+            X = np.lib.format.open_memmap(X_file + '.part', mode='w+', dtype=np.float32, shape=(len(ROIs),) + img.shape)
+            y = np.lib.format.open_memmap(y_file + '.part', mode='w+', dtype=np.int8, shape=(len(ROIs),) + target.shape)
+        
+        X[i] = impute_nan(img)
+        y[i] = target
+    
+    X.flush()
+    y.flush()
+    del X, y
+    
+    os.replace(X_file + '.part', X_file)
+    os.replace(y_file + '.part', y_file)
+    np.savetxt(rois_file, ROIs, fmt='%s')
+    
+    return X_file, y_file
+
 class GenDEBRIS(Dataset): # Extend PyTorch's Dataset class
-    def __init__(self, mode = 'train', transform=None, standardization=None, path = dataset_path, agg_to_water= True):
+    def __init__(self, mode = 'train', transform=None, standardization=None, path = dataset_path, agg_to_water= True, cache = None):
         
-        if mode=='train':
-            self.ROIs = np.genfromtxt(os.path.join(path, 'splits', 'train_X.txt'),dtype='str')
-                
-        elif mode=='test':
-            self.ROIs = np.genfromtxt(os.path.join(path, 'splits', 'test_X.txt'),dtype='str')
-                
-        elif mode=='val':
-            self.ROIs = np.genfromtxt(os.path.join(path, 'splits', 'val_X.txt'),dtype='str')
-            
-        else:
-            raise
-            
-        self.X = []           # Loaded Images
-        self.y = []           # Loaded Output masks
-            
-        for roi in tqdm(self.ROIs, desc = 'Load '+mode+' set to memory'):
-            
-            # Construct file and folder name from roi
-            roi_folder = '_'.join(['S2'] + roi.split('_')[:-1])               # Get Folder Name
-            roi_name = '_'.join(['S2'] + roi.split('_'))                      # Get File Name
-            roi_file = os.path.join(path, 'patches', roi_folder,roi_name + '.tif')       # Get File path
-            roi_file_cl = os.path.join(path, 'patches', roi_folder,roi_name + '_cl.tif') # Get Class Mask
-            
-            # Load Classsification Mask
-            ds = gdal.Open(roi_file_cl)
-            temp = np.copy(ds.ReadAsArray().astype(np.int64))
-            
-            # Aggregation
-            if agg_to_water:
-                temp[temp==15]=7          # Mixed Water to Marine Water Class
-                temp[temp==14]=7          # Wakes to Marine Water Class
-                temp[temp==13]=7          # Cloud Shadows to Marine Water Class
-                temp[temp==12]=7          # Waves to Marine Water Class
+        self.ROIs = load_rois(path, mode)
+        
+        if cache:
+            # Memory-mapped cache (cache is its folder), built once if it is missing or stale
+            self.cache_X, self.cache_y, rois_file = cache_files(cache, mode, agg_to_water)
             
-            # Categories from 1 to 0
-            temp = np.copy(temp - 1)
-            ds=None                   # Close file
+            if not all(os.path.exists(f) for f in [self.cache_X, self.cache_y, rois_file]) or \
+               not np.array_equal(np.atleast_1d(np.genfromtxt(rois_file, dtype='str')), self.ROIs):
+                build_cache(mode, path, cache, agg_to_water)
             
-            self.y.append(temp)
+            self.load_cache()
             
-            # Load Patch
-            ds = gdal.Open(roi_file)
-            temp = np.copy(ds.ReadAsArray())
-            ds=None
-            self.X.append(temp)          
-
-        self.impute_nan = np.tile(bands_mean, (temp.shape[1],temp.shape[2],1))
+        else:
+            self.X = []           # Loaded Images
+            self.y = []           # Loaded Output masks
+                
+            for roi in tqdm(self.ROIs, desc = 'Load '+mode+' set to memory'):
+                
+                img, target = load_roi(path, roi, agg_to_water)
+                
+                self.y.append(target)
+                self.X.append(impute_nan(img))  # CxHxW float32
+        
         self.mode = mode
         self.transform = transform
         self.standardization = standardization
         self.length = len(self.y)
         self.path = path
         self.agg_to_water = agg_to_water
+        self.cache = cache
+        
+    def load_cache(self):
+        # Read-only memory maps: the DataLoader workers share the pages of the cache instead of copying it
+        self.X = np.load(self.cache_X, mmap_mode='r')
+        self.y = np.load(self.cache_y, mmap_mode='r')
+    
+    def __getstate__(self):
+        # The memory maps are not pickled to the workers (spawn), they are opened again there
+        state = self.__dict__.copy()
+        if self.cache:
+            state['X'] = state['y'] = None
+        return state
         
     def __len__(self):
 
@@ -102,17 +171,15 @@ class GenDEBRIS(Dataset): # Extend PyTorch's Dataset class
     
     def __getitem__(self, index):
         
-        img = self.X[index]
-        target = self.y[index]
-
-        img = np.moveaxis(img, [0, 1, 2], [2, 0, 1]).astype('float32')       # CxWxH to WxHxC
+        if self.cache and self.X is None:
+            self.load_cache()
         
-        nan_mask = np.isnan(img)
-        img[nan_mask] = self.impute_nan[nan_mask]
+        # Samples stay CxHxW float32 (nan already imputed), the transforms work on this layout
+        img = torch.tensor(self.X[index])
+        target = torch.from_numpy(self.y[index].astype(np.int64))
         
         if self.transform is not None:
-            target = target[:,:,np.newaxis]
-            stack = np.concatenate([img, target], axis=-1).astype('float32') # In order to rotate-transform both mask and image
+            stack = torch.cat([img, target[np.newaxis].float()])             # In order to rotate-transform both mask and image
         
             stack = self.transform(stack)
 
@@ -136,9 +203,54 @@ class RandomRotationTransform:
     def __call__(self, x):
         angle = random.choice(self.angles)
         return F.rotate(x, angle)
+
+class BatchRandomRotationFlip:
+    """Rotate by one of the given angles (multiples of 90) and horizontally flip with
+    probability p, each sample of a (B,C,H,W) batch and its (B,H,W) integer mask,
+    on the device of the batch."""
+
+    def __init__(self, angles, p = 0.5):
+        self.rotations = torch.tensor([(angle // 90) % 4 for angle in angles])  # Counter-clockwise quarter turns
+        self.p = p
+
+    def __call__(self, image, target):
+        device = image.device
+        
+        # Random rotation and flip of each sample
+        rotations = self.rotations.to(device)[torch.randint(len(self.rotations), (image.shape[0],), device = device)]
+        flips = torch.rand(image.shape[0], device = device) < self.p
+        
+        image = torch.where(flips[:, None, None, None], image.flip(-1), image)
+        target = torch.where(flips[:, None, None], target.flip(-1), target)
+        
+        # Samples with the same number of quarter turns are rotated together (square patches)
+        for k in rotations.unique().tolist():
+            if k:
+                ind = rotations == k
+                image[ind] = torch.rot90(image[ind], k, dims = (-2, -1))
+                target[ind] = torch.rot90(target[ind], k, dims = (-2, -1))
+        
+        return image, target
     
 ###############################################################
 # Weighting Function for Semantic Segmentation                #
 ###############################################################
 def gen_weights(class_distribution, c = 1.02):
-    return 1/torch.log(c + class_distribution)
\ No newline at end of file
+    return 1/torch.log(c + class_distribution)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    # Options
+    parser.add_argument('--path', default=dataset_path, help='Path to dataset')
+    parser.add_argument('--cache', default=os.path.join(dataset_path, 'cache'), help='Folder of the memory-mapped .npy cache')
+    parser.add_argument('--agg_to_water', default=True, type=bool,  help='Aggregate Mixed Water, Wakes, Cloud Shadows, Waves with Marine Water')
+
+    args = parser.parse_args()
+    options = vars(args)  # convert to ordinary dict
+    
+    # One-time cache of all the splits
+    for mode in ['train', 'val', 'test']:
+        X_file, y_file = build_cache(mode, options['path'], options['cache'], options['agg_to_water'])
+        print(mode + ' cache is saved at: ' + X_file + ', ' + y_file)
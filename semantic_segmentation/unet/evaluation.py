@@ -10,12 +10,15 @@ Description: evaluation.py includes the code in order to produce
 
 import os
 import sys
+import time
 import random
 import logging
 import rasterio
+from rasterio.windows import Window
 import argparse
 import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from os.path import dirname as up
 
 import torch
@@ -28,7 +31,7 @@ from dataloader import GenDEBRIS, bands_mean, bands_std
 
 sys.path.append(os.path.join(up(up(up(os.path.abspath(__file__)))), 'utils'))
 from metrics import Evaluation, confusion_matrix
-from assets import labels
+from assets import labels, encode_labels
 
 random.seed(0)
 np.random.seed(0)
@@ -39,19 +42,142 @@ root_path = up(up(up(os.path.abspath(__file__))))
 logging.basicConfig(filename=os.path.join(root_path, 'logs','evaluating_unet.log'), filemode='a',level=logging.INFO, format='%(name)s - %(levelname)s - %(message)s')
 logging.info('*'*10)
 
-def main(options):
-    # Transformations
+###############################################################
+# Scene inference                                             #
+###############################################################
+
+def tile_positions(length, tile_size, stride):
+    # Start of the tiles along an axis, the last tile ends at the border
+    positions = list(range(0, max(length - tile_size, 0) + 1, stride))
+    if positions[-1] + tile_size < length:
+        positions.append(length - tile_size)
+    return positions
+
+def blend_weights(tile_size, overlap):
+    # Weights of the logits of a tile, ramping up over the overlap so that neighbouring tiles blend
+    ramp = np.minimum(np.arange(tile_size) + 1, np.arange(tile_size)[::-1] + 1)
+    ramp = np.minimum(ramp, max(overlap, 1))/max(overlap, 1)
+    return torch.from_numpy(np.outer(ramp, ramp).astype(np.float32))
+
+def predict_scene(model, scene_file, output_image, options, device):
+    # Sliding-window inference on a full scene: the tiles of each row of tiles are read with a
+    # windowed read and predicted in batches, their logits are blended in the overlaps and the
+    # rows that no later tile covers are written. Memory is bounded by tile_size x scene width
+    tile_size = options['tile_size']
+    stride = tile_size - options['overlap']
     
-    transform_test = transforms.Compose([transforms.ToTensor()])
-    standardization = transforms.Normalize(bands_mean, bands_std)
+    if stride <= 0:
+        raise AssertionError("Wrong overlap, it must be smaller than the tile_size")
     
-    # Construct Data loader
+    class_codes = encode_labels(labels)
+    weights = blend_weights(tile_size, options['overlap'])
+    mean = torch.from_numpy(bands_mean)[:, None, None]
+    std = torch.from_numpy(bands_std)[:, None, None]
+    
+    with rasterio.open(scene_file, mode ='r') as src:
+        
+        height, width = src.height, src.width
+        buffer_width = max(width, tile_size)
+        
+        ys = tile_positions(height, tile_size, stride)
+        xs = tile_positions(buffer_width, tile_size, stride)
+        
+        # Georeferenced uint8 mask (0 where the scene has no data), written block by block
+        meta = src.meta.copy()
+        meta.update(driver = 'GTiff', count = 1, dtype = 'uint8', nodata = 0, compress = 'lzw',
+                    tiled = True, blockxsize = 256, blockysize = 256, BIGTIFF = 'IF_SAFER')
+        
+        # Blended logits of the rows ys[i], ..., ys[i] + tile_size
+        logits_sum = torch.zeros((options['output_channels'], tile_size, buffer_width))
+        
+        with rasterio.open(output_image, 'w', **meta) as dst:
+            
+            for i, y0 in enumerate(tqdm(ys, desc = 'Rows of tiles')):
+                
+                # Read the rows of the tiles (padded with nan beyond the borders)
+                rows = min(tile_size, height - y0)
+                strip = np.full((src.count, tile_size, buffer_width), np.nan, dtype = np.float32)
+                strip[:, :rows, :width] = src.read(window = Window(0, y0, width, rows))
+                
+                nodata = np.isnan(strip).all(0)
+                
+                # Fill nan with mean and standardize
+                strip = torch.from_numpy(np.where(np.isnan(strip), bands_mean[:, None, None], strip))
+                strip = (strip - mean)/std
+                
+                with torch.no_grad():
+                    for start in range(0, len(xs), options['scene_batch']):
+                        batch_xs = xs[start:start + options['scene_batch']]
+                        
+                        batch = torch.stack([strip[:, :, x0:x0 + tile_size] for x0 in batch_xs]).to(device)
+                        logits = model(batch).float().cpu()
+                        
+                        for x0, tile_logits in zip(batch_xs, logits):
+                            logits_sum[:, :, x0:x0 + tile_size] += tile_logits*weights
+                
+                # Rows before the next row of tiles are final (the weights are positive,
+                # so the argmax of the weighted sum is the argmax of the blended logits)
+                final_rows = (ys[i + 1] if i + 1 < len(ys) else height) - y0
+                
+                mask = class_codes[logits_sum[:, :final_rows, :width].argmax(0).numpy()]
+                mask[nodata[:final_rows, :width]] = 0
+                
+                dst.write(mask[np.newaxis], window = Window(0, y0, width, final_rows))
+                
+                # Shift the blended logits to the next row of tiles
+                logits_sum[:, :tile_size - final_rows] = logits_sum[:, final_rows:].clone()
+                logits_sum[:, tile_size - final_rows:] = 0
+            
+            dst.update_tags(**src.tags())
+    
+    return output_image
 
-    dataset_test = GenDEBRIS('test', transform=transform_test, standardization = standardization, agg_to_water = options['agg_to_water'])
+###############################################################
+# Prediction of masks                                         #
+###############################################################
 
-    test_loader = DataLoader(   dataset_test, 
-                                batch_size = options['batch'], 
-                                shuffle = False)
+def read_roi(path, roi):
+    # Metadata and CxHxW float32 image (nan filled with the band means) of a patch
+    roi_folder = '_'.join(['S2'] + roi.split('_')[:-1])             # Get Folder Name
+    roi_name = '_'.join(['S2'] + roi.split('_'))                    # Get File Name
+    roi_file = os.path.join(path, roi_folder,roi_name + '.tif')     # Get File path
+    
+    # Read metadata of the initial image
+    with rasterio.open(roi_file, mode ='r') as src:
+        tags = src.tags().copy()
+        meta = src.meta
+        image = src.read()
+        dtype = image.dtype
+    
+    # Update meta to reflect the number of layers
+    meta.update(count = 1)
+    
+    image = np.where(np.isnan(image), bands_mean[:, None, None], image).astype('float32')
+    
+    return meta, tags, dtype, image
+
+def patch_groups(patches):
+    # Indices of the patches of a batch grouped by shape, each group is one forward pass
+    groups = {}
+    for j, patch in enumerate(patches):
+        groups.setdefault(patch[-1].shape, []).append(j)
+    return list(groups.values())
+
+def write_mask(output_image, meta, tags, dtype, mask):
+    with rasterio.open(output_image, 'w', **meta) as dst:
+        
+        dst.write_band(1, mask.astype(dtype)) # In order to be in the same dtype
+        
+        dst.update_tags(**tags)
+
+###############################################################
+# Evaluation                                                  #
+###############################################################
+
+def main(options):
+    # Transformations
+    
+    standardization = transforms.Normalize(bands_mean, bands_std)
     
     global labels
     # Aggregate Distribution Mixed Water, Wakes, Cloud Shadows, Waves with Marine Water
@@ -82,7 +208,24 @@ def main(options):
         torch.cuda.empty_cache()
 
     model.eval()
+    
+    if options['scene']:
+        # Scene inference mode (no test set evaluation)
+        os.makedirs(options['gen_masks_path'], exist_ok=True)
+        output_image = os.path.join(options['gen_masks_path'], os.path.basename(options['scene']).split('.tif')[0] + '_unet.tif')
+        
+        print("Scene mask is saved at: " + predict_scene(model, options['scene'], output_image, options, device))
+        logging.info("Scene mask is saved at: " + output_image)
+        return
+
+    # Construct Data loader
+
+    dataset_test = GenDEBRIS('test', transform=None, standardization = standardization, agg_to_water = options['agg_to_water'], cache = options['cache'])  # Samples are already CxHxW tensors
 
+    test_loader = DataLoader(   dataset_test, 
+                                batch_size = options['batch'], 
+                                shuffle = False)
+    
     y_true = []
     y_predicted = []
     
@@ -124,54 +267,53 @@ def main(options):
             
             path = os.path.join(root_path, 'data', 'patches')
             ROIs = np.genfromtxt(os.path.join(root_path, 'data', 'splits', 'test_X.txt'),dtype='str')
-
-            impute_nan = np.tile(bands_mean, (256,256,1))
-                        
-            for roi in tqdm(ROIs):
-            
-                roi_folder = '_'.join(['S2'] + roi.split('_')[:-1])             # Get Folder Name
-                roi_name = '_'.join(['S2'] + roi.split('_'))                    # Get File Name
-                roi_file = os.path.join(path, roi_folder,roi_name + '.tif')     # Get File path
             
-                os.makedirs(options['gen_masks_path'], exist_ok=True)
+            os.makedirs(options['gen_masks_path'], exist_ok=True)
             
-                output_image = os.path.join(options['gen_masks_path'], os.path.basename(roi_file).split('.tif')[0] + '_unet.tif')
+            batches = [ROIs[i:i + options['predict_batch']] for i in range(0, len(ROIs), options['predict_batch'])]
+            class_codes = encode_labels(labels)
             
-                # Read metadata of the initial image
-                with rasterio.open(roi_file, mode ='r') as src:
-                    tags = src.tags().copy()
-                    meta = src.meta
-                    image = src.read()
-                    image = np.moveaxis(image, (0, 1, 2), (2, 0, 1))
-                    dtype = src.read(1).dtype
+            start_time = time.time()
             
-                # Update meta to reflect the number of layers
-                meta.update(count = 1)
-            
-                # Write it
-                with rasterio.open(output_image, 'w', **meta) as dst:
+            # Reading and writing of the GeoTIFFs overlap with the prediction
+            with ThreadPoolExecutor(max_workers = options['io_workers']) as pool:
+                
+                reads = [pool.submit(read_roi, path, roi) for roi in batches[0]]
+                writes = []
+                
+                for i in tqdm(range(len(batches))):
                     
-                    # Preprocessing before prediction
-                    nan_mask = np.isnan(image)
-                    image[nan_mask] = impute_nan[nan_mask]
-            
-                    image = transform_test(image)
+                    patches = [read.result() for read in reads]
                     
-                    image = standardization(image)
+                    # Prefetch the next batch
+                    if i + 1 < len(batches):
+                        reads = [pool.submit(read_roi, path, roi) for roi in batches[i + 1]]
                     
-                    # Image to Cuda if exist
-                    image = image.to(device)
-            
-                    # Predictions
-                    logits = model(image.unsqueeze(0))
-            
-                    probs = torch.nn.functional.softmax(logits.detach(), dim=1).cpu().numpy()
+                    for group in patch_groups(patches):
+                        
+                        # Preprocessing before prediction
+                        image = standardization(torch.from_numpy(np.stack([patches[j][-1] for j in group])))
+                        
+                        # Image to Cuda if exist
+                        image = image.to(device)
+                        
+                        # Predictions (argmax of the logits, the softmax does not change it)
+                        predicted = class_codes[model(image).argmax(1).cpu().numpy()]
+                        
+                        # Write the masks with georeference
+                        for j, mask in zip(group, predicted):
+                            roi_name = '_'.join(['S2'] + batches[i][j].split('_'))
+                            output_image = os.path.join(options['gen_masks_path'], roi_name + '_unet.tif')
+                            
+                            meta, tags, dtype, _ = patches[j]
+                            writes.append(pool.submit(write_mask, output_image, meta, tags, dtype, mask))
+                
+                for write in writes:
+                    write.result()
             
-                    probs = probs.argmax(1).squeeze()+1
-                    
-                    # Write the mask with georeference
-                    dst.write_band(1, probs.astype(dtype).copy()) # In order to be in the same dtype
-                    dst.update_tags(**tags)
+            elapsed = time.time() - start_time
+            print("%d masks generated after %s seconds (%.2f masks/second)" % (len(ROIs), elapsed, len(ROIs)/elapsed))
+            logging.info("%d masks generated after %s seconds (%.2f masks/second)" % (len(ROIs), elapsed, len(ROIs)/elapsed))
 
 if __name__ == "__main__":
 
@@ -181,6 +323,7 @@ if __name__ == "__main__":
     parser.add_argument('--agg_to_water', default=True, type=bool,  help='Aggregate Mixed Water, Wakes, Cloud Shadows, Waves with Marine Water')
     
     parser.add_argument('--batch', default=5, type=int, help='Number of epochs to run')
+    parser.add_argument('--cache', default=None, type=str, help='Folder of the memory-mapped .npy cache of the test set (built once if missing), e.g. data/cache')
     
     # Unet parameters
     parser.add_argument('--input_channels', default=11, type=int, help='Number of input bands')
@@ -193,6 +336,14 @@ if __name__ == "__main__":
     # Produce Predicted Masks
     parser.add_argument('--predict_masks', default= True, type=bool, help='Generate test set prediction masks?')
     parser.add_argument('--gen_masks_path', default=os.path.join(root_path, 'data', 'predicted_unet'), help='Path to where to produce store predictions')
+    parser.add_argument('--predict_batch', default=16, type=int, help='Number of patches predicted per forward pass')
+    parser.add_argument('--io_workers', default=4, type=int, help='Number of threads reading and writing the GeoTIFFs in the background')
+    
+    # Scene inference (full Sentinel-2 scenes with the same 11 bands as the patches)
+    parser.add_argument('--scene', default=None, type=str, help='Path to a scene GeoTIFF, predicted with overlapping tiles instead of the test set evaluation')
+    parser.add_argument('--tile_size', default=256, type=int, help='Size of the tiles of the scene inference')
+    parser.add_argument('--overlap', default=32, type=int, help='Overlap of neighbouring tiles, where their logits are blended')
+    parser.add_argument('--scene_batch', default=16, type=int, help='Number of tiles per forward pass')
 
     args = parser.parse_args()
     options = vars(args)  # convert to ordinary dict
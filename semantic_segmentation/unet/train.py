@@ -25,7 +25,7 @@ from torch.utils.data import DataLoader
 
 sys.path.append(up(os.path.abspath(__file__)))
 from unet import UNet
-from dataloader import GenDEBRIS, bands_mean, bands_std, RandomRotationTransform , class_distr, gen_weights
+from dataloader import GenDEBRIS, bands_mean, bands_std, BatchRandomRotationFlip , class_distr, gen_weights
 
 sys.path.append(os.path.join(up(up(up(os.path.abspath(__file__)))), 'utils'))
 from metrics import Evaluation
@@ -67,11 +67,12 @@ def main(options):
     
     # Transformations
     
-    transform_train = transforms.Compose([transforms.ToTensor(),
-                                    RandomRotationTransform([-90, 0, 90, 180]),
-                                    transforms.RandomHorizontalFlip()])
+    # GenDEBRIS samples are already CxHxW float32 tensors, the training batches
+    # are rotated and flipped on the device (the masks stay integer)
+    transform_train = None
+    augmentation = BatchRandomRotationFlip([-90, 0, 90, 180])
     
-    transform_test = transforms.Compose([transforms.ToTensor()])
+    transform_test = None
     
     standardization = transforms.Normalize(bands_mean, bands_std)
     
@@ -79,8 +80,8 @@ def main(options):
     
     if options['mode']=='train':
         
-        dataset_train = GenDEBRIS('train', transform=transform_train, standardization = standardization, agg_to_water = options['agg_to_water'])
-        dataset_test = GenDEBRIS('val', transform=transform_test, standardization = standardization, agg_to_water = options['agg_to_water'])
+        dataset_train = GenDEBRIS('train', transform=transform_train, standardization = standardization, agg_to_water = options['agg_to_water'], cache = options['cache'])
+        dataset_test = GenDEBRIS('val', transform=transform_test, standardization = standardization, agg_to_water = options['agg_to_water'], cache = options['cache'])
         
         train_loader = DataLoader(  dataset_train, 
                                     batch_size = options['batch'], 
@@ -104,7 +105,7 @@ def main(options):
         
     elif options['mode']=='test':
         
-        dataset_test = GenDEBRIS('test', transform=transform_test, standardization = standardization, agg_to_water = options['agg_to_water'])
+        dataset_test = GenDEBRIS('test', transform=transform_test, standardization = standardization, agg_to_water = options['agg_to_water'], cache = options['cache'])
     
         test_loader = DataLoader(   dataset_test, 
                                     batch_size = options['batch'], 
@@ -190,6 +191,8 @@ def main(options):
                 
                 image = image.to(device)
                 target = target.to(device)
+                
+                image, target = augmentation(image, target)
     
                 optimizer.zero_grad()
                 
@@ -372,6 +375,7 @@ if __name__ == "__main__":
     parser.add_argument('--eval_every', default=1, type=int, help='How frequently to run evaluation (epochs)')
 
     # misc
+    parser.add_argument('--cache', default=None, type=str, help='Folder of the memory-mapped .npy cache of the splits (built once if missing), e.g. data/cache')
     parser.add_argument('--num_workers', default=1, type=int, help='How many cpus for loading data (0 is the main process)')
     parser.add_argument('--pin_memory', default=False, type=bool, help='Use pinned memory or not')
     parser.add_argument('--prefetch_factor', default=1, type=int, help='Number of sample loaded in advance by each worker')
@@ -111,4 +111,44 @@ rf_features = ['nm440','nm490','nm560','nm665','nm705','nm740','nm783','nm842',
 def cat_map(x):
     return cat_mapping[x]
 
-cat_mapping_vec = np.vectorize(cat_map)
\ No newline at end of file
+def label_names(mapping = cat_mapping):
+    # Names of a mapping (e.g. cat_mapping, conf_mapping) sorted by their code
+    return sorted(mapping, key = mapping.get)
+
+def labels_lut(mapping = cat_mapping, size = None):
+    # Integer lookup table from the codes of a mapping to the position of their
+    # names in label_names(mapping) (-1 for codes without a name)
+    names = label_names(mapping)
+    
+    lut = np.full(max(max(mapping.values()) + 1, size or 0), -1, dtype = np.int16)
+    lut[[mapping[name] for name in names]] = np.arange(len(names))
+    
+    return lut
+
+def encode_labels(names, mapping = cat_mapping):
+    # Class names to uint8 codes of a mapping (vectorized version of cat_map)
+    names = np.asarray(names)
+    keys = sorted(mapping)
+    codes = np.array([mapping[key] for key in keys], dtype = np.uint8)
+    keys = np.array(keys, dtype = object if names.dtype == object else None)
+    
+    ind = np.minimum(np.searchsorted(keys, names), len(keys) - 1)
+    unknown = keys[ind] != names
+    if np.any(unknown):
+        raise KeyError(names[unknown].flat[0])
+    
+    return codes[ind]
+
+def label_indices(codes, mapping = cat_mapping):
+    # Integer codes of a mapping to the position of their names in label_names(mapping)
+    # through labels_lut (codes without a name, e.g. corrupt label rasters, are an error)
+    codes = np.asarray(codes)
+    lut = labels_lut(mapping, int(codes.max(initial = 0)) + 1)
+    
+    ind = lut[codes]
+    if np.any(ind < 0):
+        raise KeyError(codes[ind < 0].flat[0])
+    
+    return ind
+
+cat_mapping_vec = encode_labels
\ No newline at end of file
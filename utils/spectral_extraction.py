@@ -10,6 +10,7 @@ Description: spectral_extraction.py extraction of the spectral signature, indice
 
 import os
 import sys
+import shutil
 import argparse
 import numpy as np
 import pandas as pd
@@ -17,39 +18,70 @@ from glob import glob
 from tqdm import tqdm
 from osgeo import gdal
 from os.path import dirname as up
+from joblib import Parallel, delayed
 
 root_path = up(up(os.path.abspath(__file__)))
 
 sys.path.append(os.path.join(root_path, 'utils'))
-from assets import s2_mapping, cat_mapping, conf_mapping, indexes_mapping, texture_mapping
+from assets import s2_mapping, cat_mapping, conf_mapping, indexes_mapping, texture_mapping, label_names, label_indices
 
-rev_cat_mapping = {v:k for k,v in cat_mapping.items()}
-rev_conf_mapping = {v:k for k,v in conf_mapping.items()}
+def codes_to_categorical(codes, mapping):
+    # Integer codes to a Categorical of the names of mapping (e.g. cat_mapping)
+    return pd.Categorical.from_codes(label_indices(codes, mapping), categories = label_names(mapping))
 
-def ImageToDataframe(RefImage, cols_mapping = {}, keep_annotated = True, coordinates = True):
+def patch_key(im_name):
+    # Sort key of a patch, shared by the s2, indices and texture files (S2_date_tile_crop[_si|_glcm].tif):
+    # date, tile and the crop index as an int (the paths sort _1.tif before _10.tif but _10_si.tif before _1_si.tif)
+    date, tile, crop = os.path.basename(im_name).split('.tif')[0].split('_')[1:4]
+    return date, tile, int(crop)
+
+def ImageToDataframe(RefImage, cols_mapping = {}, keep_annotated = True, coordinates = True, label_root = None):
     # This function transform an image with the associated class and 
-    # confidence tif files (_cl.tif and _conf.tif) to a dataframe
+    # confidence tif files (_cl.tif and _conf.tif) to a dataframe.
+    # The label files are next to the image, or in the same subfolder of label_root (e.g. the patches folder)
 
     # Read patch
     ds = gdal.Open(RefImage)
     IM = np.copy(ds.ReadAsArray())
+    
+    if label_root:
+        label_path = os.path.join(label_root, os.path.basename(up(RefImage)))
+    else:
+        label_path = up(RefImage)
 
     # Read associated confidence level patch
-    ds_conf = gdal.Open(os.path.join(up(RefImage), '_'.join(os.path.basename(RefImage).split('.tif')[0].split('_')[:4]) + '_conf.tif'))
-    IM_conf = np.copy(ds_conf.ReadAsArray())[np.newaxis, :, :]
+    ds_conf = gdal.Open(os.path.join(label_path, '_'.join(os.path.basename(RefImage).split('.tif')[0].split('_')[:4]) + '_conf.tif'))
+    IM_conf = np.copy(ds_conf.ReadAsArray())
     
     # Read associated class patch
-    ds_cl = gdal.Open(os.path.join(up(RefImage), '_'.join(os.path.basename(RefImage).split('.tif')[0].split('_')[:4]) + '_cl.tif'))
-    IM_cl = np.copy(ds_cl.ReadAsArray())[np.newaxis, :, :]
+    ds_cl = gdal.Open(os.path.join(label_path, '_'.join(os.path.basename(RefImage).split('.tif')[0].split('_')[:4]) + '_cl.tif'))
+    IM_cl = np.copy(ds_cl.ReadAsArray())
+    
+    # Pixels to keep (in row-major order)
+    if keep_annotated:
+        keep = np.flatnonzero(IM_cl.ravel() > 0) # Keep only based on non zero class
+    else:
+        keep = np.arange(IM_cl.size)
     
-    # Stack all these together
-    IM_T = np.moveaxis(np.concatenate([IM, IM_conf, IM_cl], axis = 0), 0, -1)
+    # Bands in their own dtype (float32), the coordinates are separate float64 columns
+    IM_VECT = IM.reshape([IM.shape[0], -1])[:, keep]
     
+    # Class and Confidence names from the codes
+    labels = {'Confidence': codes_to_categorical(IM_conf.ravel()[keep], conf_mapping),
+              'Class': codes_to_categorical(IM_cl.ravel()[keep], cat_mapping)}
+    
+    if cols_mapping:
+        IM_df = pd.DataFrame({k:labels[k] if k in labels else IM_VECT[v] for k, v in cols_mapping.items()})
+    else:
+        IM_df = pd.DataFrame(IM_VECT.T)
+        IM_df['Confidence'] = labels['Confidence']
+        IM_df['Class'] = labels['Class']
+        
     if coordinates:
         # Get the coordinates in space.
         padfTransform = ds.GetGeoTransform()
         
-        x_coords, y_coords = np.meshgrid(range(IM_T.shape[0]), range(IM_T.shape[1]), indexing='ij')
+        x_coords, y_coords = np.divmod(keep, IM_cl.shape[1])
         
         Xp = padfTransform[0] + y_coords*padfTransform[1] + x_coords*padfTransform[2];
         Yp = padfTransform[3] + y_coords*padfTransform[4] + x_coords*padfTransform[5]
@@ -57,36 +89,45 @@ def ImageToDataframe(RefImage, cols_mapping = {}, keep_annotated = True, coordin
         # shift to the center of the pixel
         Xp -= padfTransform[5] / 2.0
         Yp -= padfTransform[1] / 2.0
-        XpYp = np.dstack((Xp,Yp))
-        IM_T = np.concatenate((IM_T, XpYp), axis=2)
         
-    bands = IM_T.shape[-1]
-    IM_VECT = IM_T.reshape([-1,bands])
-    
-    if keep_annotated and coordinates:
-        IM_VECT = IM_VECT[IM_VECT[:,-3] > 0] # Keep only based on non zero class
-    elif keep_annotated and not coordinates:
-        IM_VECT = IM_VECT[IM_VECT[:,-1] > 0] # Keep only based on non zero class
-        
-    if cols_mapping:
-        IM_df = pd.DataFrame({k:IM_VECT[:,v] for k, v in cols_mapping.items()})
-    else:
-        IM_df = pd.DataFrame(IM_VECT)
-        
-    if coordinates:
-        IM_df['XCoords'] = IM_VECT[:,-2]
-        IM_df['YCoords'] = IM_VECT[:,-1]
+        IM_df['XCoords'] = Xp
+        IM_df['YCoords'] = Yp
     
     IM_df.date = ds.GetMetadataItem("TIFFTAG_DATETIME")
     ds = None
     ds_conf = None
     ds_cl = None
     
-    IM_df["Class"] = IM_df["Class"].apply(lambda x: rev_cat_mapping[x])
-    IM_df['Confidence'] = IM_df['Confidence'].apply(lambda x: rev_conf_mapping[x])
-    
     return IM_df
 
+def PatchToDataframe(im_name, cols_mapping = {}, label_root = None, all_features = False):
+    # Dataframe of a patch (annotated pixels) with its Date, Tile and Image info
+    temp = ImageToDataframe(im_name, cols_mapping, label_root = label_root)
+    
+    if all_features:
+        # Add the indices and texture features of the patch (same annotated pixels in the same order)
+        for feature_type, suffix, mapping in [('indices', '_si.tif', indexes_mapping), ('texture', '_glcm.tif', texture_mapping)]:
+            feature_image = os.path.join(up(up(up(im_name))), feature_type, os.path.basename(up(im_name)), os.path.basename(im_name).split('.tif')[0] + suffix)
+            features = ImageToDataframe(feature_image, mapping, coordinates = False, label_root = up(up(im_name)))
+            
+            for column in features.columns.drop(['Confidence', 'Class']):
+                temp[column] = features[column].values
+    
+    # Update Satellite and Date info
+    temp['Date'] = os.path.splitext(os.path.basename(im_name))[0].split('_')[1]
+    temp['Tile'] = os.path.splitext(os.path.basename(im_name))[0].split('_')[2]
+    temp['Image'] = os.path.splitext(os.path.basename(im_name))[0].split('_')[3]
+    
+    return temp
+
+def ParquetAppend(dataset_name, df, split):
+    # Append a dataframe to the Parquet dataset partitioned by split, Tile and Date (needs pyarrow)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    table = pa.Table.from_pandas(df.assign(split = split), preserve_index = False)
+    pq.write_to_dataset(table, dataset_name, partition_cols = ['split', 'Tile', 'Date'])
+
 def main(options):
     
     # Which features?
@@ -111,75 +152,79 @@ def main(options):
         # Get patches files without _cl and _conf associated files
         patches = glob(os.path.join(options['path'], 'texture', '*/*.tif'))
         
+    elif options['type']=='all':
+        mapping = s2_mapping
+        h5_prefix = 'dataset_all'
+        
+        # Spectral signatures of the patches, joined with their indices and texture features
+        patches = glob(os.path.join(options['path'], 'patches', '*/*.tif'))
+        
     else:
-        raise AssertionError("Wrong Type, select between s2, indices or texture")
+        raise AssertionError("Wrong Type, select between s2, indices, texture or all")
         
-    patches = [p for p in patches if ('_cl.tif' not in p) and ('_conf.tif' not in p)]
+    # Sorted, so that the rows of the s2, indices and texture stores are in the same order
+    patches = sorted((p for p in patches if ('_cl.tif' not in p) and ('_conf.tif' not in p)), key = patch_key)
 
-    # Read splits
-    X_train = np.genfromtxt(os.path.join(options['path'], 'splits','train_X.txt'),dtype='str')
-    
-    X_val = np.genfromtxt(os.path.join(options['path'], 'splits','val_X.txt'),dtype='str')
+    # Read splits (split of each date_tile_image id)
+    image_splits = {}
+    for split in ['train', 'val', 'test']:
+        for img_name in np.atleast_1d(np.genfromtxt(os.path.join(options['path'], 'splits', split + '_X.txt'),dtype='str')):
+            image_splits[img_name] = split
     
-    X_test = np.genfromtxt(os.path.join(options['path'], 'splits','test_X.txt'),dtype='str')
-    
-    dataset_name = os.path.join(options['path'], h5_prefix + '_nonindex.h5')
-    hdf = pd.HDFStore(dataset_name, mode = 'w')
-    
-    # For each patch extract the spectral signatures and store them
-    for im_name in tqdm(patches):
+    # Group the patches by split
+    split_patches = {'train': [], 'val': [], 'test': []}
+    for im_name in patches:
 
         # Get date_tile_image info
 
         img_name = '_'.join(os.path.basename(im_name).split('.tif')[0].split('_')[1:4])
         
-        # Generate Dataframe from Image
-        if img_name in X_train:
-            split = 'train'
-            temp = ImageToDataframe(im_name, mapping)
-        elif img_name in X_val:
-            split = 'val'
-            temp = ImageToDataframe(im_name, mapping)
-        elif img_name in X_test:
-            split = 'test'
-            temp = ImageToDataframe(im_name, mapping)
-        else:
+        if img_name not in image_splits:
             raise AssertionError("Image not in train,val,test splits")
         
-        # Update Satellite and Date info
-        temp['Date'] = os.path.splitext(os.path.basename(im_name))[0].split('_')[1]
-        temp['Tile'] = os.path.splitext(os.path.basename(im_name))[0].split('_')[2]
-        temp['Image'] = os.path.splitext(os.path.basename(im_name))[0].split('_')[3]
-        # Store data
-        hdf.append(split, temp, format='table', data_columns=True, min_itemsize={'Class':27,
-                                                                                 'Confidence':8,
-                                                                                 'Date':8,
-                                                                                 'Image':3,
-                                                                                 'Tile':5})
-    
-    hdf.close()
-    
-    # Read the stored file and fix an indexing problem (indexes were not incremental and unique)
-    hdf_old = pd.HDFStore(dataset_name, mode = 'r')
-    
-    df_train = hdf_old['train'].copy(deep=True)
-    df_val = hdf_old['val'].copy(deep=True)
-    df_test = hdf_old['test'].copy(deep=True)
+        split_patches[image_splits[img_name]].append(im_name)
     
-    df_train.reset_index(drop = True, inplace = True)
-    df_val.reset_index(drop = True, inplace = True)
-    df_test.reset_index(drop = True, inplace = True)
-
-    hdf_old.close()
+    if options['format'] == 'parquet':
+        dataset_name = os.path.join(options['path'], h5_prefix + '.parquet')
+        shutil.rmtree(dataset_name, ignore_errors = True)
+    else:
+        dataset_name = os.path.join(options['path'], h5_prefix + '.h5')
+        hdf = pd.HDFStore(dataset_name, mode = 'w')
     
-    # Store the fixed table to a new dataset file
-    dataset_name_fixed = os.path.join(options['path'], h5_prefix+'.h5')
-
-    df_train.to_hdf(dataset_name_fixed, key='train', mode='a', format='table', data_columns=True)
-    df_val.to_hdf(dataset_name_fixed, key='val', mode='a', format='table', data_columns=True)
-    df_test.to_hdf(dataset_name_fixed, key='test', mode='a', format='table', data_columns=True)
+    # Stored rows (annotated pixels) of each split, also the next row index (incremental and unique indexes)
+    split_rows = {'train': 0, 'val': 0, 'test': 0}
     
-    os.remove(dataset_name)
+    # For each patch extract the spectral signatures (process pool) and store them (single writer)
+    with Parallel(n_jobs = options['n_jobs']) as parallel, tqdm(total = len(patches)) as progress_bar:
+        
+        for split in ['train', 'val', 'test']:
+            for start in range(0, len(split_patches[split]), options['batch_patches']):
+                batch = split_patches[split][start:start + options['batch_patches']]
+                
+                # Generate Dataframes from Images
+                temps = parallel(delayed(PatchToDataframe)(im_name, mapping, options['label_root'], options['type']=='all') for im_name in batch)
+                
+                split_df = pd.concat(temps, ignore_index = True)
+                split_df.index += split_rows[split]
+                split_rows[split] += len(split_df)
+                
+                # Store data
+                if options['format'] == 'parquet':
+                    ParquetAppend(dataset_name, split_df, split)
+                else:
+                    hdf.append(split, split_df, format='table', data_columns=True, min_itemsize={'Class':27,
+                                                                                             'Confidence':8,
+                                                                                             'Date':8,
+                                                                                             'Image':3,
+                                                                                             'Tile':5})
+                
+                progress_bar.update(len(batch))
+    
+    if options['format'] != 'parquet':
+        hdf.close()
+    
+    for split in ['train', 'val', 'test']:
+        print('%s: %d patches, %d annotated pixels' % (split, len(split_patches[split]), split_rows[split]))
 
 if __name__ == "__main__":
 
@@ -187,7 +232,11 @@ if __name__ == "__main__":
 
     # Options
     parser.add_argument('--path', default=os.path.join(root_path, 'data'), help='Path to dataset')
-    parser.add_argument('--type', default='s2', type=str, help=' Select between s2, indices or texture for Spectral Signatures, Produced Indices or GLCM Textures, respectively')
+    parser.add_argument('--type', default='s2', type=str, help=' Select between s2, indices or texture for Spectral Signatures, Produced Indices or GLCM Textures, respectively, or all for all of them in the same table')
+    parser.add_argument('--format', default='hdf5', type=str, choices=['hdf5', 'parquet'], help='Store as hdf5 tables (<prefix>.h5) or as a Parquet dataset partitioned by split, Tile and Date (<prefix>.parquet)')
+    parser.add_argument('--n_jobs', default= -2, type=int, help='How many cores?')
+    parser.add_argument('--batch_patches', default= 64, type=int, help='Number of patches extracted in parallel before each write to the hdf5 file')
+    parser.add_argument('--label_root', default=None, help='Folder with the _cl.tif and _conf.tif files, e.g. the patches folder when engineering_patches.py was run with --labels none (default: next to each patch)')
 
     args = parser.parse_args()
     options = vars(args)  # convert to ordinary dict